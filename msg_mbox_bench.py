@@ -0,0 +1,773 @@
+"""Воспроизводимый замер производительности на синтетическом корпусе писем.
+
+Корпус генерируется офлайн из зерна (--seed), поэтому результаты разных
+коммитов можно сравнивать между собой. Каждый этап запускается в отдельном
+процессе, чтобы пиковая память (RSS) относилась только к нему.
+
+С --soak вместо замеров выполняется прогон на утечки: тысячи файлов
+конвертируются одним конвертером, и RSS и число открытых дескрипторов
+после разогрева не должны расти.
+
+Пример:
+    python msg_mbox_bench.py --messages 2000 --attachment-kb 256 --json new.json
+    python msg_mbox_bench.py --size-mb 200 --json new.json --compare old.json
+    python msg_mbox_bench.py --soak 5000 --soak-input папка_с_msg --memory-cap 8
+"""
+import sys
+import os
+import json
+import time
+import base64
+import random
+import struct
+import gzip
+import shutil
+import hashlib
+import logging
+import argparse
+import platform
+import subprocess
+import tempfile
+import multiprocessing
+from datetime import datetime, timedelta, timezone
+from email.header import Header
+from email.parser import BytesHeaderParser
+
+from msg_mbox_core import (MessageConverter, iter_mbox_entries, iter_mbox_headers, safe_mbox_loader,
+                           decode_header_safe, extract_attachments, OUTPUT_SINKS, MBOX_STREAM_CHUNK)
+
+logger = logging.getLogger("msg_mbox_bench")
+
+RESULT_VERSION = 1
+STAGES = ("split", "scan_headers", "safe_mbox_loader", "decode_header_safe", "convert_mbox_to_eml",
+          "gunzip", "convert_mbox_gz", "convert_msg_to_eml", "extract_attachments")
+DECODE_HEADERS = ("Subject", "From", "To")
+
+WORDS = ("отчёт", "квартал", "договор", "счёт", "встреча", "проект", "оплата", "поставка",
+         "согласование", "бюджет", "письмо", "заявка", "report", "invoice", "meeting", "draft")
+NAMES = ("Иван Петров", "Мария Сидорова", "Олег Кузнецов", "Анна Смирнова", "John Smith")
+ATTACHMENT_TYPES = (("pdf", "application/pdf"), ("docx", "application/octet-stream"),
+                    ("xlsx", "application/octet-stream"), ("zip", "application/zip"))
+PNG_HEADER = b"\x89PNG\r\n\x1a\n"
+SOAK_FILES = 100
+SOAK_SAMPLES = 20
+SOAK_RSS_GROWTH_MB = 16
+SOAK_FD_GROWTH = 0
+
+
+class SyntheticAttachment:
+    """Вложение с теми же атрибутами, что и у extract_msg"""
+
+    def __init__(self, filename, data, mime_type, cid=None):
+        self.longFilename = filename
+        self.shortFilename = None
+        self.data = data
+        self.mimeType = mime_type
+        self.cid = cid
+        self.contentId = cid
+
+
+class SyntheticMsg:
+    """Замена extract_msg.Message: замер сборки EML без разбора MSG-файла"""
+
+    def __init__(self, spec):
+        charset = spec["charset"]
+        self.sender = spec["sender"]
+        self.recipients = [spec["to"]]
+        self.subject = spec["subject"]
+        self.body = spec["body"]
+        self.htmlBody = spec["html"].encode(charset, errors="replace") if spec["html"] else None
+        self.date = spec["date"]
+        self.messageId = spec["message_id"]
+        self.attachments = (
+            [SyntheticAttachment(name, data, "image/png", cid) for name, data, cid in spec["inline"]] +
+            [SyntheticAttachment(name, data, mime) for name, data, mime in spec["attachments"]]
+        )
+
+    def close(self):
+        pass
+
+
+def random_text(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    lines = [" ".join(words[i:i + 12]) for i in range(0, len(words), 12)]
+    return "\n".join(lines) + "\n"
+
+
+def message_spec(rng, number, params):
+    """Описание одного письма; одинаково для MBOX и синтетических MSG"""
+    charset = params.charsets[number % len(params.charsets)]
+    subject = f"{rng.choice(WORDS).capitalize()} {' '.join(rng.choice(WORDS) for _ in range(4))} #{number}"
+    body = random_text(rng, int(params.body_kb * 1024 * rng.uniform(0.5, 1.5)))
+
+    inline = []
+    html = None
+    if rng.random() < params.inline_ratio:
+        for k in range(params.inline_images):
+            size = int(params.image_kb * 1024 * rng.uniform(0.5, 1.5))
+            inline.append((f"image{k}.png", PNG_HEADER + rng.randbytes(size), f"img{number}_{k}@bench.local"))
+        images = "".join(f'<p><img src="cid:{cid}"></p>' for _name, _data, cid in inline)
+        html = f"<html><body><p>{body.replace(chr(10), '<br>')}</p>{images}</body></html>"
+    elif rng.random() < 0.5:
+        html = f"<html><body><p>{body.replace(chr(10), '<br>')}</p></body></html>"
+
+    attachments = []
+    if rng.random() < params.attachment_ratio:
+        for k in range(rng.randint(1, params.max_attachments)):
+            extension, mime = rng.choice(ATTACHMENT_TYPES)
+            size = int(params.attachment_kb * 1024 * rng.uniform(0.5, 1.5))
+            attachments.append((f"{rng.choice(WORDS)}_{number}_{k}.{extension}", rng.randbytes(size), mime))
+
+    return {
+        "charset": charset,
+        "raw_headers": charset != "utf-8" and rng.random() < params.raw_header_ratio,
+        "sender": f"{rng.choice(NAMES)} <user{number % 97}@example.ru>",
+        "to": f"{rng.choice(NAMES)} <box{number % 13}@example.ru>",
+        "subject": subject,
+        "body": body,
+        "html": html,
+        "inline": inline,
+        "attachments": attachments,
+        "date": datetime(2020, 1, 1) + timedelta(minutes=number * 37),
+        "message_id": f"<{number}.{params.seed}@bench.local>",
+    }
+
+
+def iter_message_specs(params, count):
+    rng = random.Random(params.seed)
+    for number in range(count):
+        yield message_spec(rng, number, params)
+
+
+def encode_address(value, charset, raw):
+    name, address = value.rsplit(" ", 1)
+    if raw:
+        return name.encode(charset, errors="replace") + b" " + address.encode()
+    return Header(name, charset).encode().encode("ascii") + b" " + address.encode()
+
+
+def encode_subject(value, charset, raw):
+    if raw:
+        return value.encode(charset, errors="replace")
+    return Header(value, charset).encode().encode("ascii")
+
+
+def base64_lines(data):
+    encoded = base64.b64encode(data)
+    return b"\n".join(encoded[i:i + 76] for i in range(0, len(encoded), 76))
+
+
+def text_part(content, subtype, charset):
+    body = base64.encodebytes(content.encode(charset, errors="replace"))
+    return (f"Content-Type: text/{subtype}; charset=\"{charset}\"\n"
+            f"Content-Transfer-Encoding: base64\n\n").encode() + body
+
+
+def multipart(subtype, parts, boundary):
+    chunks = [f"Content-Type: multipart/{subtype}; boundary=\"{boundary}\"\n\n".encode()]
+    for part in parts:
+        chunks.append(f"--{boundary}\n".encode() + part + b"\n")
+    chunks.append(f"--{boundary}--\n".encode())
+    return b"".join(chunks)
+
+
+def build_mbox_message(spec, number):
+    """Письмо в формате mboxo: 8-битные или MIME-кодированные заголовки, CID-картинки, вложения"""
+    charset = spec["charset"]
+    body = text_part(spec["body"], "plain", charset)
+    if spec["html"]:
+        html = text_part(spec["html"], "html", charset)
+        if spec["inline"]:
+            images = [(f"Content-Type: image/png\nContent-Transfer-Encoding: base64\n"
+                       f"Content-ID: <{cid}>\nContent-Disposition: inline; filename=\"{name}\"\n\n").encode() +
+                      base64_lines(data) + b"\n"
+                      for name, data, cid in spec["inline"]]
+            html = multipart("related", [html] + images, f"rel_{number}")
+        body = multipart("alternative", [body, html], f"alt_{number}")
+    if spec["attachments"]:
+        files = [(f"Content-Type: {mime}\nContent-Transfer-Encoding: base64\n"
+                  f"Content-Disposition: attachment; filename=\"{name}\"\n\n").encode() +
+                 base64_lines(data) + b"\n"
+                 for name, data, mime in spec["attachments"]]
+        body = multipart("mixed", [body] + files, f"mix_{number}")
+
+    raw = spec["raw_headers"]
+    date = spec["date"]
+    headers = [
+        b"From: " + encode_address(spec["sender"], charset, raw),
+        b"To: " + encode_address(spec["to"], charset, raw),
+        b"Subject: " + encode_subject(spec["subject"], charset, raw),
+        f"Date: {date.strftime('%a, %d %b %Y %H:%M:%S')} +0300".encode(),
+        f"Message-ID: {spec['message_id']}".encode(),
+        b"MIME-Version: 1.0",
+    ]
+    envelope = f"From user{number % 97}@example.ru {date.strftime('%a %b %d %H:%M:%S %Y')}\n".encode()
+    message = b"\n".join(headers) + b"\n" + body
+    # mboxo: строки, начинающиеся с "From ", в теле экранируются
+    message = message.replace(b"\nFrom ", b"\n>From ")
+    return envelope + message + b"\n"
+
+
+OLE_SECTOR = 512
+OLE_MINI_SECTOR = 64
+OLE_MINI_CUTOFF = 4096
+OLE_FREE, OLE_END, OLE_FAT, OLE_DIFAT, OLE_NONE = 0xFFFFFFFF, 0xFFFFFFFE, 0xFFFFFFFD, 0xFFFFFFFC, 0xFFFFFFFF
+
+
+def write_ole_file(path, tree):
+    """Минимальный составной файл OLE (CFB версии 3) из дерева {имя: bytes или вложенный dict}"""
+    entries = [{"name": "Root Entry", "type": 5, "kids": [], "data": b""}]
+
+    def add(node, parent):
+        for name, value in node.items():
+            storage = isinstance(value, dict)
+            entries[parent]["kids"].append(len(entries))
+            entries.append({"name": name, "type": 1 if storage else 2, "kids": [],
+                            "data": b"" if storage else bytes(value)})
+            if storage:
+                add(value, len(entries) - 1)
+    add(tree, 0)
+
+    sectors = []
+    chains = []
+
+    def place(data):
+        start = sum(len(chunk) for chunk in sectors) // OLE_SECTOR
+        count = max(1, -(-len(data) // OLE_SECTOR))
+        sectors.append(data + b"\0" * (count * OLE_SECTOR - len(data)))
+        chains.append((start, count))
+        return start
+
+    # потоки меньше OLE_MINI_CUTOFF хранятся в мини-потоке корневой записи
+    mini = bytearray()
+    minifat = []
+    for entry in entries[1:]:
+        data = entry["data"]
+        entry["start"] = 0 if entry["type"] == 1 else OLE_END
+        if entry["type"] != 2 or not data:
+            continue
+        if len(data) < OLE_MINI_CUTOFF:
+            count = -(-len(data) // OLE_MINI_SECTOR)
+            entry["start"] = len(minifat)
+            minifat.extend(range(len(minifat) + 1, len(minifat) + count))
+            minifat.append(OLE_END)
+            mini += data + b"\0" * (count * OLE_MINI_SECTOR - len(data))
+        else:
+            entry["start"] = place(data)
+    entries[0]["data"] = bytes(mini)
+    entries[0]["start"] = place(bytes(mini)) if mini else OLE_END
+    minifat_start = OLE_END
+    if minifat:
+        minifat += [OLE_FREE] * (-len(minifat) % (OLE_SECTOR // 4))
+        minifat_start = place(struct.pack(f"<{len(minifat)}I", *minifat))
+
+    # дети хранилища — сбалансированное дерево в порядке (длина имени, имя в верхнем регистре)
+    def balance(ids):
+        if not ids:
+            return OLE_NONE
+        middle = len(ids) // 2
+        entries[ids[middle]]["left"] = balance(ids[:middle])
+        entries[ids[middle]]["right"] = balance(ids[middle + 1:])
+        return ids[middle]
+    for entry in entries:
+        entry.setdefault("left", OLE_NONE)
+        entry.setdefault("right", OLE_NONE)
+    for entry in entries:
+        entry["child"] = balance(sorted(entry["kids"], key=lambda i: (len(entries[i]["name"]),
+                                                                    entries[i]["name"].upper())))
+    directory = bytearray()
+    for entry in entries:
+        name = entry["name"].encode("utf-16-le")
+        directory += struct.pack("<64sHBB3I16sI8s8sIQ", name, len(name) + 2, entry["type"], 1,
+                                 entry["left"], entry["right"], entry["child"], b"", 0, b"", b"",
+                                 entry["start"], len(entry["data"]))
+    while len(directory) % OLE_SECTOR:
+        directory += struct.pack("<68s3I48s", b"", OLE_NONE, OLE_NONE, OLE_NONE, b"")
+    directory_start = place(bytes(directory))
+
+    used = sum(len(chunk) for chunk in sectors) // OLE_SECTOR
+    per_sector = OLE_SECTOR // 4
+    fat_count = difat_count = 0
+    while used + fat_count + difat_count > fat_count * per_sector:
+        fat_count += 1
+        difat_count = max(0, -(-(fat_count - 109) // (per_sector - 1)))
+    fat = [OLE_FREE] * (fat_count * per_sector)
+    for start, count in chains:
+        fat[start:start + count] = list(range(start + 1, start + count)) + [OLE_END]
+    fat_sectors = list(range(used, used + fat_count))
+    for sector in fat_sectors:
+        fat[sector] = OLE_FAT
+    difat_start = used + fat_count
+    for sector in range(difat_start, difat_start + difat_count):
+        fat[sector] = OLE_DIFAT
+    difat = bytearray()
+    for k in range(difat_count):
+        chunk = fat_sectors[109 + k * (per_sector - 1):109 + (k + 1) * (per_sector - 1)]
+        chunk += [OLE_FREE] * (per_sector - 1 - len(chunk))
+        difat += struct.pack(f"<{per_sector}I", *chunk, difat_start + k + 1 if k + 1 < difat_count else OLE_END)
+    head = fat_sectors[:109] + [OLE_FREE] * (109 - len(fat_sectors[:109]))
+    header = struct.pack("<8s16s5H6s9I109I", b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", b"", 0x3E, 3, 0xFFFE, 9, 6, b"",
+                         0, fat_count, directory_start, 0, OLE_MINI_CUTOFF, minifat_start, len(minifat) // per_sector,
+                         difat_start if difat_count else OLE_END, difat_count, *head)
+    with open(path, "wb") as f:
+        f.write(header)
+        f.writelines(sectors)
+        f.write(struct.pack(f"<{len(fat)}I", *fat))
+        f.write(difat)
+
+
+def msg_storage(header, fixed, variable):
+    """Хранилище MSG: потоки свойств переменной длины и поток __properties_version1.0"""
+    node = {}
+    properties = bytearray(header)
+    for tag, value in fixed:
+        properties += struct.pack("<II8s", tag, 6, value)
+    for prop, kind, value in variable:
+        data = value.encode("utf-16-le") if kind == 0x001F else value
+        node[f"__substg1.0_{prop:04X}{kind:04X}"] = data
+        properties += struct.pack("<IIII", (prop << 16) | kind, 6, len(data), 0)
+    node["__properties_version1.0"] = bytes(properties)
+    return node
+
+
+def build_msg_file(spec, path):
+    """Настоящий MSG-файл с письмом spec: читается extract_msg так же, как файлы Outlook"""
+    attachments = ([(name, data, "image/png", cid) for name, data, cid in spec["inline"]] +
+                   [(name, data, mime, None) for name, data, mime in spec["attachments"]])
+    variable = [(0x001A, 0x001F, "IPM.Note"), (0x0037, 0x001F, spec["subject"]), (0x1000, 0x001F, spec["body"]),
+                (0x0C1A, 0x001F, spec["sender"]), (0x0E04, 0x001F, spec["to"]),
+                (0x1035, 0x001F, spec["message_id"])]
+    if spec["html"]:
+        variable.append((0x1013, 0x0102, spec["html"].encode("utf-8")))
+    submitted = int((spec["date"].replace(tzinfo=timezone.utc).timestamp() + 11644473600) * 10 ** 7)
+    tree = msg_storage(struct.pack("<8xIIII8x", 1, len(attachments), 1, len(attachments)),
+                       [(0x00390040, struct.pack("<Q", submitted))], variable)
+    tree["__nameid_version1.0"] = {"__substg1.0_00020102": b"", "__substg1.0_00030102": b"",
+                                    "__substg1.0_00040102": b""}
+    tree["__recip_version1.0_#00000000"] = msg_storage(
+        b"\0" * 8, [(0x0C150003, struct.pack("<I", 1))],
+        [(0x3001, 0x001F, spec["to"]), (0x3003, 0x001F, spec["to"]), (0x39FE, 0x001F, spec["to"])])
+    for number, (name, data, mime, cid) in enumerate(attachments):
+        variable = [(0x3707, 0x001F, name), (0x3704, 0x001F, name), (0x370E, 0x001F, mime), (0x3701, 0x0102, data)]
+        if cid:
+            variable.append((0x3712, 0x001F, cid))
+        tree[f"__attach_version1.0_#{number:08X}"] = msg_storage(
+            b"\0" * 8, [(0x37050003, struct.pack("<I", 1)), (0x0E210003, struct.pack("<I", number))], variable)
+    write_ole_file(path, tree)
+
+
+def generate_corpus(params, workdir):
+    """Генерация MBOX-файла корпуса; --size-mb перекрывает --messages"""
+    mbox_path = os.path.join(workdir, "corpus.mbox")
+    limit = int(params.size_mb * 1024 * 1024) if params.size_mb else None
+    count = 0
+    size = 0
+    rng = random.Random(params.seed)
+    with open(mbox_path, "wb") as f:
+        while (size < limit) if limit else (count < params.messages):
+            data = build_mbox_message(message_spec(rng, count, params), count)
+            f.write(data)
+            size += len(data)
+            count += 1
+    return {"mbox": mbox_path, "messages": count, "bytes": size}
+
+
+def peak_rss_mb():
+    """Пиковый RSS текущего процесса в МБ (None, если платформа не сообщает его)"""
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+            return round(psutil.Process().memory_info().peak_wset / (1024 * 1024), 1)
+        except (ImportError, AttributeError):
+            return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak /= 1024
+    return round(peak / 1024, 1)
+
+
+def current_rss_mb():
+    """Текущий RSS процесса в МБ (None, если платформа не сообщает его)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+        return round(psutil.Process().memory_info().rss / (1024 * 1024), 1)
+    except ImportError:
+        return None
+
+
+def open_fd_count():
+    """Число открытых дескрипторов процесса (None, если платформа не сообщает его)"""
+    for fd_dir in ("/proc/self/fd", "/dev/fd"):
+        if os.path.isdir(fd_dir):
+            return len(os.listdir(fd_dir))
+    try:
+        import psutil
+        process = psutil.Process()
+        return process.num_fds() if hasattr(process, "num_fds") else process.num_handles()
+    except ImportError:
+        return None
+
+
+def memory_cap_bytes(params):
+    return int(params.memory_cap * 1024 * 1024)
+
+
+def stage_split(params, corpus, workdir):
+    messages = 0
+    size = 0
+    for _offset, raw in iter_mbox_entries(corpus["mbox"]):
+        messages += 1
+        size += len(raw)
+    return messages, size
+
+
+def stage_scan_headers(params, corpus, workdir):
+    messages = 0
+    for _offset, _length, headers in iter_mbox_headers(corpus["mbox"]):
+        messages += 1
+        headers.get("Subject")
+    return messages, corpus["bytes"]
+
+
+def stage_safe_mbox_loader(params, corpus, workdir):
+    return len(safe_mbox_loader(corpus["mbox"])), corpus["bytes"]
+
+
+def stage_decode_header_safe(params, corpus, workdir):
+    parser = BytesHeaderParser()
+    values = []
+    for _offset, raw in iter_mbox_entries(corpus["mbox"]):
+        headers = parser.parsebytes(raw.split(b"\n", 1)[1])
+        values.extend(headers[name] for name in DECODE_HEADERS if headers[name])
+    size = sum(len(str(value)) for value in values)
+
+    started = time.perf_counter()
+    for value in values:
+        decode_header_safe(value)
+    return len(values), size, time.perf_counter() - started
+
+
+def stage_convert_mbox_to_eml(params, corpus, workdir):
+    converter = MessageConverter(os.path.join(workdir, "mbox_out"), params.workers, sink=params.sink)
+    try:
+        result = converter.convert_mbox_to_eml(corpus["mbox"])
+    finally:
+        converter.close()
+    return len(result), corpus["bytes"]
+
+
+def gzip_corpus(corpus):
+    """Сжатая копия корпуса (создаётся один раз, вне замера)"""
+    gz_path = corpus["mbox"] + ".gz"
+    if not os.path.exists(gz_path):
+        with open(corpus["mbox"], "rb") as src, gzip.open(gz_path + ".tmp", "wb", compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(gz_path + ".tmp", gz_path)
+    return gz_path
+
+
+def stage_gunzip(params, corpus, workdir):
+    """Одна распаковка без разбора — ориентир для convert_mbox_gz"""
+    gz_path = gzip_corpus(corpus)
+    started = time.perf_counter()
+    with gzip.open(gz_path, "rb") as f:
+        while f.read(MBOX_STREAM_CHUNK):
+            pass
+    return corpus["messages"], corpus["bytes"], time.perf_counter() - started
+
+
+def stage_convert_mbox_gz(params, corpus, workdir):
+    gz_path = gzip_corpus(corpus)
+    converter = MessageConverter(os.path.join(workdir, "mbox_gz_out"), params.workers, sink=params.sink)
+    started = time.perf_counter()
+    try:
+        result = converter.convert_mbox_to_eml(gz_path)
+    finally:
+        converter.close()
+    return len(result), corpus["bytes"], time.perf_counter() - started
+
+
+def stage_convert_msg_to_eml(params, corpus, workdir):
+    count = min(corpus["messages"], params.msg_count) if params.msg_count else corpus["messages"]
+    msgs = [SyntheticMsg(spec) for spec in iter_message_specs(params, count)]
+    size = sum(len(spec_data) for msg in msgs for spec_data in
+               [msg.body.encode(), msg.htmlBody or b""] + [att.data for att in msg.attachments])
+
+    converter = MessageConverter(os.path.join(workdir, "msg_out"), sink=params.sink,
+                                 memory_cap=memory_cap_bytes(params))
+    started = time.perf_counter()
+    try:
+        for number, msg in enumerate(msgs):
+            digest = hashlib.sha256(f"{params.seed}:{number}".encode()).hexdigest()
+            converter.convert_msg_object(msg, f"synthetic_{number:06d}.msg", digest)
+        converter.flush_writes()
+    finally:
+        converter.close()
+    return count, size, time.perf_counter() - started
+
+
+def stage_extract_attachments(params, corpus, workdir):
+    extract_attachments([corpus["mbox"]], os.path.join(workdir, "attachments"), params.workers)
+    return corpus["messages"], corpus["bytes"]
+
+
+def run_stage(name, params, corpus, workdir, queue):
+    """Выполняется в отдельном процессе; возвращает замер через очередь"""
+    try:
+        stage = globals()[f"stage_{name}"]
+        started = time.perf_counter()
+        result = stage(params, corpus, workdir)
+        elapsed = time.perf_counter() - started
+        if len(result) == 3:
+            messages, size, elapsed = result
+        else:
+            messages, size = result
+        queue.put({"seconds": elapsed, "messages": messages, "bytes": size, "peak_rss_mb": peak_rss_mb()})
+    except Exception as e:
+        queue.put({"error": f"{type(e).__name__}: {e}"})
+
+
+def measure_stage(name, params, corpus, workdir):
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    for attempt in range(params.repeat):
+        stage_dir = tempfile.mkdtemp(prefix=f"{name}_", dir=workdir)
+        queue = context.Queue()
+        process = context.Process(target=run_stage, args=(name, params, corpus, stage_dir, queue))
+        process.start()
+        run = queue.get()
+        process.join()
+        if "error" in run:
+            return run
+        runs.append(run)
+
+    best = min(runs, key=lambda run: run["seconds"])
+    seconds = max(best["seconds"], 1e-9)
+    return {
+        "seconds": round(best["seconds"], 4),
+        "runs": [round(run["seconds"], 4) for run in runs],
+        "messages": best["messages"],
+        "bytes": best["bytes"],
+        "messages_per_s": round(best["messages"] / seconds, 1),
+        "mb_per_s": round(best["bytes"] / seconds / (1024 * 1024), 2),
+        "peak_rss_mb": max((run["peak_rss_mb"] for run in runs if run["peak_rss_mb"] is not None),
+                           default=None),
+    }
+
+
+def soak_sources(params, workdir):
+    """Файлы для прогона на утечки: --soak-input или SOAK_FILES сгенерированных MSG"""
+    if params.soak_input:
+        from msg_mbox_cli import expand_inputs
+        files = expand_inputs([params.soak_input])
+        if not files:
+            raise ValueError(f"в {params.soak_input} нет файлов MSG или MBOX")
+        return files
+    soak_dir = os.path.join(workdir, "soak")
+    os.makedirs(soak_dir, exist_ok=True)
+    files = []
+    for number, spec in enumerate(iter_message_specs(params, SOAK_FILES)):
+        path = os.path.join(soak_dir, f"soak_{number:04d}.msg")
+        build_msg_file(spec, path)
+        files.append(path)
+    return files
+
+
+def run_soak(params, workdir):
+    """Конвертирует params.soak файлов одним конвертером и проверяет,
+    что RSS и число открытых дескрипторов после разогрева не растут."""
+    files = soak_sources(params, workdir)
+    converter = MessageConverter(os.path.join(workdir, "soak_out"), sink=params.sink,
+                                 memory_cap=memory_cap_bytes(params))
+    warmup = max(1, params.soak // 10)
+    step = max(1, (params.soak - warmup) // SOAK_SAMPLES)
+    samples = []
+    errors = 0
+    started = time.perf_counter()
+    try:
+        for number in range(params.soak):
+            try:
+                converter.convert_file(files[number % len(files)])
+            except Exception as e:
+                errors += 1
+                logger.debug(f"Ошибка конвертации в прогоне на утечки: {e}")
+            done = number + 1
+            if done >= warmup and ((done - warmup) % step == 0 or done == params.soak):
+                # без gc.collect(): файлы, которые закрыл бы только сборщик мусора, должны считаться утечкой
+                converter.flush_writes()
+                samples.append({"files": done, "rss_mb": current_rss_mb(), "open_fds": open_fd_count()})
+    finally:
+        converter.close()
+
+    first, last = samples[0], samples[-1]
+    rss_growth = (round(last["rss_mb"] - first["rss_mb"], 1)
+                  if first["rss_mb"] is not None and last["rss_mb"] is not None else None)
+    fd_growth = (last["open_fds"] - first["open_fds"]
+                 if first["open_fds"] is not None and last["open_fds"] is not None else None)
+    failures = []
+    if rss_growth is not None and rss_growth > SOAK_RSS_GROWTH_MB:
+        failures.append(f"RSS вырос на {rss_growth} МБ (допустимо {SOAK_RSS_GROWTH_MB} МБ)")
+    if fd_growth is not None and fd_growth > SOAK_FD_GROWTH:
+        failures.append(f"открытых дескрипторов стало больше на {fd_growth}")
+    if errors == params.soak:
+        failures.append("ни один файл не сконвертирован")
+    return {
+        "files": params.soak,
+        "errors": errors,
+        "seconds": round(time.perf_counter() - started, 2),
+        "rss_growth_mb": rss_growth,
+        "fd_growth": fd_growth,
+        "peak_rss_mb": peak_rss_mb(),
+        "samples": samples,
+        "failures": failures,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(old, new):
+    """Строки сравнения скорости этапов с предыдущим прогоном"""
+    lines = []
+    for name, stage in new["stages"].items():
+        before = old.get("stages", {}).get(name)
+        if "error" in stage or not before or "error" in before:
+            continue
+        change = (stage["messages_per_s"] / before["messages_per_s"] - 1) * 100 if before["messages_per_s"] else 0
+        lines.append(f"{name}: {before['messages_per_s']} -> {stage['messages_per_s']} писем/с "
+                     f"({change:+.1f}%), RSS {before['peak_rss_mb']} -> {stage['peak_rss_mb']} МБ")
+    return lines
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Замер производительности конвертации на синтетическом корпусе")
+    parser.add_argument("--messages", type=int, default=500, help="число писем в корпусе (по умолчанию 500)")
+    parser.add_argument("--size-mb", type=float, help="генерировать письма, пока MBOX не достигнет размера")
+    parser.add_argument("--attachment-ratio", type=float, default=0.3, help="доля писем с вложениями")
+    parser.add_argument("--max-attachments", type=int, default=3, help="максимум вложений в письме")
+    parser.add_argument("--attachment-kb", type=float, default=64, help="средний размер вложения, КБ")
+    parser.add_argument("--inline-ratio", type=float, default=0.2, help="доля писем с CID-картинками")
+    parser.add_argument("--inline-images", type=int, default=2, help="число CID-картинок в письме")
+    parser.add_argument("--image-kb", type=float, default=16, help="средний размер картинки, КБ")
+    parser.add_argument("--body-kb", type=float, default=4, help="средний размер текста письма, КБ")
+    parser.add_argument("--charsets", default="utf-8,cp1251,koi8-r",
+                        help="кодировки заголовков и текста по кругу (через запятую)")
+    parser.add_argument("--raw-header-ratio", type=float, default=0.3,
+                        help="доля не-UTF-8 писем с 8-битными заголовками без MIME-кодирования")
+    parser.add_argument("--msg-count", type=int, help="число синтетических MSG (по умолчанию как писем в MBOX)")
+    parser.add_argument("--seed", type=int, default=1, help="зерно генератора корпуса")
+    parser.add_argument("--stages", default=",".join(STAGES), help="этапы через запятую")
+    parser.add_argument("--repeat", type=int, default=3, help="повторов каждого этапа, берётся лучший")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="число процессов для convert_mbox_to_eml")
+    parser.add_argument("--sink", choices=OUTPUT_SINKS, default="directory", help="формат результата конвертации")
+    parser.add_argument("--workdir", help="папка для корпуса и результатов (по умолчанию временная)")
+    parser.add_argument("--json", dest="json_path", default="bench_results.json",
+                        help="куда записать результаты (по умолчанию bench_results.json)")
+    parser.add_argument("--compare", metavar="PATH", help="сравнить с результатами предыдущего прогона")
+    parser.add_argument("--memory-cap", type=float, default=0, metavar="МБ",
+                        help="лимит памяти на вложения одного MSG (0 — без лимита)")
+    parser.add_argument("--soak", type=int, default=0, metavar="N",
+                        help="вместо замеров сконвертировать N файлов и проверить, что RSS и "
+                             "число открытых файлов не растут")
+    parser.add_argument("--soak-input", metavar="PATH",
+                        help="файл или папка с MSG/MBOX для --soak (по умолчанию синтетические)")
+    args = parser.parse_args(argv)
+    args.charsets = [charset.strip() for charset in args.charsets.split(",") if charset.strip()]
+    args.stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = [stage for stage in args.stages if stage not in STAGES]
+    if unknown:
+        parser.error(f"неизвестные этапы: {', '.join(unknown)}")
+    return args
+
+
+def soak_main(args, workdir):
+    soak = run_soak(args, workdir)
+    logger.info(f"Прогон на утечки: {soak['files']} файлов за {soak['seconds']} с, ошибок {soak['errors']}, "
+                f"прирост RSS {soak['rss_growth_mb']} МБ, дескрипторов {soak['fd_growth']}")
+    for failure in soak["failures"]:
+        logger.error(failure)
+    params = {key: value for key, value in vars(args).items() if key not in ("json_path", "compare", "workdir")}
+    results = {
+        "version": RESULT_VERSION,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": params,
+        "soak": soak,
+    }
+    with open(args.json_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=4)
+    return 1 if soak["failures"] else 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    # Логи конвертера не должны влиять на замер
+    logging.getLogger("msg_mbox_core").setLevel(logging.WARNING)
+    logging.getLogger("extract_msg").setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory(prefix="msg_mbox_bench_") as temp_dir:
+        workdir = args.workdir or temp_dir
+        os.makedirs(workdir, exist_ok=True)
+
+        if args.soak:
+            return soak_main(args, workdir)
+
+        started = time.perf_counter()
+        corpus = generate_corpus(args, workdir)
+        logger.info(f"Корпус: {corpus['messages']} писем, {corpus['bytes'] / (1024 * 1024):.1f} МБ "
+                    f"за {time.perf_counter() - started:.1f} с")
+
+        stages = {}
+        for name in args.stages:
+            stages[name] = measure_stage(name, args, corpus, workdir)
+            stage = stages[name]
+            if "error" in stage:
+                logger.error(f"{name}: {stage['error']}")
+            else:
+                logger.info(f"{name}: {stage['seconds']} с, {stage['messages_per_s']} писем/с, "
+                            f"{stage['mb_per_s']} МБ/с, RSS {stage['peak_rss_mb']} МБ")
+
+    params = {key: value for key, value in vars(args).items() if key not in ("json_path", "compare", "workdir")}
+    results = {
+        "version": RESULT_VERSION,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "params": params,
+        "corpus": {"messages": corpus["messages"], "bytes": corpus["bytes"]},
+        "stages": stages,
+    }
+    with open(args.json_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=4)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            for line in compare_results(json.load(f), results):
+                logger.info(line)
+    return 1 if any("error" in stage for stage in stages.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+"""Консольная конвертация MSG и MBOX в EML без графического интерфейса.
+
+Пример:
+    python msg_mbox_cli.py "D:/mail/**/*.msg" archive.mbox -o D:/eml -j 8 --json summary.json
+    python msg_mbox_cli.py archive.mbox --list --filter "счёт"
+    python msg_mbox_cli.py D:/mail -o D:/attachments --attachments -j 0
+"""
+import sys
+import os
+import glob
+import json
+import time
+import logging
+import argparse
+
+from msg_mbox_core import (MessageConverter, iter_conversion_results, build_run_report, save_run_report,
+                           load_mbox_index, filter_index_entries, extract_attachments,
+                           ErrorReport, is_mbox_path, OUTPUT_LAYOUTS, OUTPUT_SINKS, QUARANTINE_DIR,
+                           MBOX_EXTENSIONS)
+
+logger = logging.getLogger("msg_mbox_cli")
+
+SUPPORTED_EXTENSIONS = ('.msg',) + MBOX_EXTENSIONS
+
+
+def expand_inputs(patterns):
+    """Раскрытие масок и папок в список файлов .msg/.mbox (в том числе сжатых) без повторов"""
+    files = []
+    seen = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = []
+            for root, _dirs, names in os.walk(pattern):
+                matches.extend(os.path.join(root, name) for name in sorted(names))
+        else:
+            matches = sorted(glob.glob(pattern, recursive=True)) or [pattern]
+        for path in matches:
+            if not path.lower().endswith(SUPPORTED_EXTENSIONS) or path in seen:
+                continue
+            seen.add(path)
+            files.append(path)
+    return files
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Конвертация файлов MSG и MBOX в EML без графического интерфейса"
+    )
+    parser.add_argument("inputs", nargs="+", help="файлы, маски (поддерживается **) или папки")
+    parser.add_argument("-o", "--output-dir", help="папка для сохранения .eml")
+    parser.add_argument("--list", action="store_true",
+                        help="не конвертировать, а вывести список писем MBOX (читаются только заголовки)")
+    parser.add_argument("--filter", default="", metavar="ТЕКСТ",
+                        help="для --list: только письма с ТЕКСТом в теме, отправителе или дате")
+    parser.add_argument("--attachments", action="store_true",
+                        help="не конвертировать, а извлечь вложения в -o: файлы по sha256 (одинаковые "
+                             "записываются один раз) и манифест manifest.jsonl")
+    parser.add_argument("-j", "--workers", type=int, default=1,
+                        help="число процессов (0 — по числу ядер, по умолчанию 1)")
+    parser.add_argument("--no-resume", dest="resume", action="store_false",
+                        help="не использовать журнал и конвертировать всё заново")
+    parser.add_argument("--dedup", action="store_true",
+                        help="пропускать письма, уже записанные в эту папку (по Message-ID или содержимому)")
+    parser.add_argument("--layout", choices=OUTPUT_LAYOUTS, default="flat",
+                        help="раскладка результата: flat — одна папка, date — ГГГГ/ММ, hash — по хэшу имени")
+    parser.add_argument("--sink", choices=OUTPUT_SINKS, default="directory",
+                        help="формат результата: отдельные .eml, zip/tar-архив, Maildir или один mbox")
+    parser.add_argument("--json", dest="json_path", metavar="PATH",
+                        help="записать итоговую сводку в JSON ('-' — в stdout)")
+    parser.add_argument("--search-index", action="store_true",
+                        help="добавлять письма в полнотекстовый индекс для поиска в программе")
+    parser.add_argument("--quarantine", action="store_true",
+                        help=f"копировать MSG и письма MBOX с ошибками в <output-dir>/{QUARANTINE_DIR}")
+    parser.add_argument("--fsync", action="store_true",
+                        help="сбрасывать записанные файлы на диск (медленнее, но надёжнее при сбое питания)")
+    parser.add_argument("--memory-cap", type=float, default=0, metavar="МБ",
+                        help="лимит памяти на вложения одного MSG; сверх него вложения "
+                             "пишутся через временные файлы (0 — без лимита)")
+    parser.add_argument("--profile-sample", type=float, default=0.0, metavar="ДОЛЯ",
+                        help="профилировать cProfile указанную долю писем (например 0.01)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="выводить только ошибки")
+    args = parser.parse_args(argv)
+    if not args.list and not args.output_dir:
+        parser.error("требуется -o/--output-dir (или --list)")
+    return args
+
+
+def write_summary(summary, json_path):
+    if json_path == "-":
+        json.dump(summary, sys.stdout, ensure_ascii=False, indent=4)
+        sys.stdout.write("\n")
+        return
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=4)
+
+
+def list_messages(files, text):
+    """Вывод писем MBOX из индекса: файл, номер, дата, отправитель, тема"""
+    for file_path in files:
+        if not is_mbox_path(file_path):
+            continue
+        entries = load_mbox_index(file_path)
+        for row in filter_index_entries(entries, text):
+            _offset, _length, subject, sender, date = entries[row]
+            print("\t".join([file_path, str(row + 1), date or "", sender or "", subject or ""]))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(
+        level=logging.WARNING if args.quiet else logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+    files = expand_inputs(args.inputs)
+    if not files:
+        logger.error("Не найдено файлов .msg или .mbox")
+        return 2
+
+    if args.list:
+        list_messages(files, args.filter)
+        return 0
+
+    if args.attachments:
+        summary = extract_attachments(files, args.output_dir, args.workers)
+        if args.json_path:
+            write_summary(summary, args.json_path)
+        logger.info(f"Готово: {summary['attachments']} вложений из {len(files)} файлов, "
+                    f"записано новых: {summary['stored']}, ошибок: {len(summary['errors'])}, "
+                    f"{summary['elapsed']} с; манифест: {summary['manifest']}")
+        return 1 if summary["errors"] else 0
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    converter = MessageConverter(args.output_dir, args.workers, args.resume, args.dedup, args.layout, args.sink,
+                                 args.profile_sample, args.search_index, args.fsync,
+                                 int(args.memory_cap * 1024 * 1024))
+
+    started = time.time()
+    converted = 0
+    errors = []
+    error_report = ErrorReport(args.output_dir, args.quarantine)
+    for file_path, result, error in iter_conversion_results(files, converter, args.workers):
+        if error is not None:
+            errors.append({"file": file_path, "error": str(error)})
+            error_report.add(file_path, error)
+            logger.error(f"Ошибка при конвертации {file_path}: {error}")
+        elif isinstance(result, list):
+            converted += len(result)
+        elif result:
+            converted += 1
+        error_report.add_stats_errors(converter.stats)
+    error_report.add_stats_errors(converter.stats)
+    error_report.close()
+
+    summary = build_run_report(converter.stats, files, converted, errors, time.time() - started, args.output_dir)
+    summary["error_report"] = error_report.path if error_report.count else None
+    report_path = save_run_report(args.output_dir, summary)
+    if args.json_path:
+        write_summary(summary, args.json_path)
+    logger.info(f"Готово: {converted} писем из {len(files)} файлов, ошибок: {error_report.count}, "
+                f"{summary['elapsed']} с, {summary['messages_per_s']} писем/с; отчёт: {report_path}")
+    if error_report.count:
+        logger.info(f"Журнал ошибок: {error_report.path}")
+    return 1 if error_report.count else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
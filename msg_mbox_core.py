@@ -0,0 +1,3453 @@
+import os
+import io
+import sys
+import codecs
+import unicodedata
+import mimetypes
+import email
+import email.policy
+import logging
+import re
+import hashlib
+import time
+import json
+import base64
+import binascii
+import random
+import mmap
+import contextlib
+import tempfile
+import shutil
+import heapq
+import threading
+import queue
+from collections import Counter, deque
+from datetime import datetime
+from email.generator import Generator
+from email.parser import BytesHeaderParser
+from email.utils import formatdate, parsedate_to_datetime
+from email.header import decode_header
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.base import MIMEBase
+from email.mime.image import MIMEImage
+from email import encoders
+from html import unescape as html_unescape
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FILE = os.path.join(os.path.expanduser("~"), ".msg_to_eml_config.json")
+INDEX_DIR = os.path.join(os.path.expanduser("~"), ".msg_to_eml_index")
+INDEX_VERSION = 2
+SEARCH_DB = os.path.join(os.path.expanduser("~"), ".msg_to_eml_search.sqlite")
+SEARCH_BODY_LIMIT = 256 * 1024
+INDEX_TAIL_SIZE = 4096
+MBOX_SHARD_MIN_SIZE = 64 * 1024 * 1024
+MBOX_SHARDS_PER_WORKER = 4
+JOURNAL_DIR = ".msg_to_eml_journal"
+DEDUP_DB = ".msg_to_eml_dedup.sqlite"
+OUTPUT_LAYOUTS = ("flat", "date", "hash")
+OUTPUT_SINKS = ("directory", "zip", "tar", "maildir", "mbox")
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+WRITE_THREADS = 2
+WRITE_QUEUE_BYTES = 32 * 1024 * 1024
+WRITE_BATCH = 32
+PROGRESS_INTERVAL = 0.25
+REPORT_DIR = ".msg_to_eml_reports"
+QUARANTINE_DIR = "quarantine"
+ERROR_VIEW_LIMIT = 1000
+SLOWEST_LIMIT = 10
+CONVERSION_STAGES = ("read", "decode", "mime", "write")
+HASH_CHUNK_SIZE = 1024 * 1024
+ATTACHMENT_MANIFEST = "manifest.jsonl"
+MIME_MAX_DEPTH = 32
+MSG_ATTACH_PREFIX = "__attach_version1.0_#"
+MSG_MEMORY_CAP = 64 * 1024 * 1024
+
+class StreamingEmlWriter:
+    """Запись MIME-дерева в файл без сборки всего письма в памяти.
+
+    Части из streams пишутся base64-блоками прямо из источника (bytes или
+    файлового объекта); остальные части сериализуются как в as_string().
+    """
+    CHUNK_SIZE = 57 * 1024  # кратно 57 байтам: ровные строки base64 по 76 символов
+
+    def __init__(self, fp, streams=None):
+        self.fp = fp
+        self.streams = streams or {}
+        self.policy = email.policy.compat32.clone(max_line_length=0)
+
+    def write(self, part):
+        if part.is_multipart():
+            if not part.get_boundary():
+                part.set_boundary(make_mime_boundary())
+            boundary = part.get_boundary()
+            self.write_headers(part)
+            if part.preamble is not None:
+                self.fp.write(part.preamble + '\n')
+            for subpart in part.get_payload():
+                self.fp.write('--' + boundary + '\n')
+                self.write(subpart)
+                self.fp.write('\n')
+            self.fp.write('--' + boundary + '--\n')
+            if part.epilogue is not None:
+                self.fp.write(part.epilogue)
+        elif id(part) in self.streams:
+            self.write_headers(part)
+            for chunk in iter_source_chunks(self.streams[id(part)], self.CHUNK_SIZE):
+                self.fp.write(base64.encodebytes(chunk).decode('ascii'))
+        else:
+            Generator(self.fp, mangle_from_=False, maxheaderlen=0).flatten(part)
+
+    def write_headers(self, part):
+        for name, value in part.raw_items():
+            self.fp.write(self.policy.fold(name, value))
+        self.fp.write('\n')
+
+class ByteCounter(io.BufferedIOBase):
+    """Обёртка над бинарным файлом приёмника, считающая записанные байты"""
+
+    def __init__(self, raw):
+        super().__init__()
+        self.raw = raw
+        self.count = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.count += memoryview(data).nbytes
+        return self.raw.write(data)
+
+    def flush(self):
+        if not self.raw.closed:
+            self.raw.flush()
+
+def make_mime_boundary():
+    return '=' * 15 + '%019d' % random.randrange(sys.maxsize) + '=='
+
+def iter_source_chunks(source, chunk_size):
+    """Блоки данных вложения из bytes-подобного объекта, файла или итератора блоков"""
+    if hasattr(source, 'read'):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        return
+    if not isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        yield from source
+        return
+    view = memoryview(source)
+    for pos in range(0, len(view), chunk_size):
+        yield view[pos:pos + chunk_size]
+
+def _source_size(source):
+    if hasattr(source, 'read'):
+        return os.fstat(source.fileno()).st_size
+    return len(source)
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ConversionJournal:
+    """Журнал конвертации в папке результата для продолжения прерванных запусков.
+
+    Каждый процесс дописывает свой файл journal-<pid>.jsonl; при открытии
+    читаются все файлы журнала, проверки выполняются по словарям в памяти.
+    """
+    def __init__(self, output_dir):
+        self.journal_dir = os.path.join(output_dir, JOURNAL_DIR)
+        self.hashes = {}    # (путь, размер, mtime) -> sha256 исходного файла
+        self.sources = {}   # sha256 -> путь .eml для MSG, None для MBOX
+        self.messages = {}  # sha256 MBOX -> {номер письма: путь .eml}
+        self.claims = {}    # (sha256, номер письма или None для MSG) -> имя в приёмнике
+        # записи копятся в памяти до commit(), пока приёмник не завершит свой файл
+        self.deferred = False
+        self._held = []
+        self._fp = None
+        self.load()
+
+    def load(self):
+        if not os.path.isdir(self.journal_dir):
+            return
+        for name in os.listdir(self.journal_dir):
+            if not name.endswith(".jsonl"):
+                continue
+            with open(os.path.join(self.journal_dir, name), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self._apply(json.loads(line))
+                    except (ValueError, KeyError):
+                        # оборванная запись после аварийного завершения
+                        continue
+
+    def _apply(self, record):
+        kind = record["type"]
+        if kind == "hash":
+            self.hashes[(record["path"], record["size"], record["mtime"])] = record["sha256"]
+        elif kind == "message":
+            self.messages.setdefault(record["sha256"], {})[record["index"]] = record["eml"]
+        elif kind == "source":
+            self.sources[record["sha256"]] = record.get("eml")
+        elif kind == "claim":
+            self.claims[(record["sha256"], record["index"])] = record["name"]
+
+    def _append(self, record):
+        self._apply(record)
+        if self.deferred:
+            self._held.append(record)
+            return
+        self._write(record)
+
+    def _write(self, record):
+        if self._fp is None:
+            os.makedirs(self.journal_dir, exist_ok=True)
+            path = os.path.join(self.journal_dir, f"journal-{os.getpid()}.jsonl")
+            self._fp = open(path, 'a', encoding='utf-8')
+        self._fp.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._fp.flush()
+
+    def source_digest(self, path):
+        """sha256 исходного файла; пересчитывается только при смене размера или mtime"""
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_size, st.st_mtime)
+        digest = self.hashes.get(key)
+        if digest is None:
+            digest = file_sha256(path)
+            self._append({"type": "hash", "path": key[0], "size": key[1],
+                          "mtime": key[2], "sha256": digest})
+        return digest
+
+    def is_source_done(self, digest):
+        return digest in self.sources
+
+    def source_output(self, digest):
+        if self.sources.get(digest) is not None:
+            return self.sources[digest]
+        outputs = self.messages.get(digest, {})
+        return [outputs[index] for index in sorted(outputs)]
+
+    def message_output(self, digest, index):
+        return self.messages.get(digest, {}).get(index)
+
+    def record_message(self, digest, index, eml_path):
+        self._append({"type": "message", "sha256": digest, "index": index, "eml": eml_path})
+
+    def record_claim(self, digest, index, name):
+        """Имя, выбранное письму до записи: после сбоя письмо запишется под ним же"""
+        self._append({"type": "claim", "sha256": digest, "index": index, "name": name})
+
+    def claimed_name(self, digest, index):
+        return self.claims.get((digest, index))
+
+    def claimed_names(self, subdir):
+        return [os.path.basename(name) for name in self.claims.values() if os.path.dirname(name) == subdir]
+
+    def record_source(self, digest, path, eml_path=None):
+        self._append({"type": "source", "sha256": digest, "path": os.path.abspath(path), "eml": eml_path})
+
+    def commit(self):
+        """Записать отложенные записи: приёмник закрыт и письма в нём читаемы"""
+        held, self._held = self._held, []
+        for record in held:
+            self._write(record)
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+def normalize_message_id(value):
+    """Message-ID без угловых скобок и пробелов, домен в нижнем регистре"""
+    if not value:
+        return ""
+    value = str(value).strip()
+    match = re.search(r'<([^<>]+)>', value)
+    if match:
+        value = match.group(1)
+    value = value.strip()
+    local, at, domain = value.rpartition('@')
+    return f"{local}@{domain.lower()}" if at else value
+
+def _dedup_part_digest(part):
+    if isinstance(part, str):
+        part = part.replace('\r\n', '\n').replace('\r', '\n').rstrip()
+        part = part.encode('utf-8', errors='surrogateescape')
+    digest = hashlib.sha256()
+    for chunk in iter_source_chunks(part or b'', HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    if hasattr(part, 'seek'):
+        part.seek(0)
+    return digest.digest()
+
+def message_dedup_key(message_id, content_parts):
+    """Ключ дедупликации: Message-ID, а если его нет — sha256 текста, HTML и вложений.
+
+    content_parts — [текст, HTML, данные вложений...], одинаково для MSG и MBOX
+    (см. iter_mbox_content_parts); перебирается, только если Message-ID нет.
+    Текст сравнивается без учёта переводов строк (CRLF, CR, LF) и пробелов в конце,
+    вложения — побайтно и без учёта порядка. Письма, текст которых почтовая
+    программа переформатировала при сохранении, по содержимому не совпадут.
+    """
+    message_id = normalize_message_id(message_id)
+    if message_id:
+        return "mid:" + message_id
+    digests = [_dedup_part_digest(part) for part in content_parts]
+    digest = hashlib.sha256()
+    for part_digest in digests[:2] + sorted(digests[2:]):
+        digest.update(part_digest)
+    return "sha:" + digest.hexdigest()
+
+class DedupStore:
+    """Множество ключей уже записанных писем (SQLite в папке результата).
+
+    Ключ закрепляется за первым письмом-владельцем; повторная обработка того
+    же письма (например, после сбоя) дубликатом не считается.
+    """
+    def __init__(self, output_dir):
+        import sqlite3
+        os.makedirs(output_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(output_dir, DEDUP_DB), timeout=60,
+                                  isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, owner TEXT NOT NULL)")
+
+    def claim(self, key, owner):
+        """True, если письмо нужно записать"""
+        cursor = self.db.execute("INSERT OR IGNORE INTO seen (key, owner) VALUES (?, ?)", (key, owner))
+        if cursor.rowcount:
+            return True
+        row = self.db.execute("SELECT owner FROM seen WHERE key = ?", (key,)).fetchone()
+        return row is not None and row[0] == owner
+
+    def close(self):
+        self.db.close()
+
+def _file_tail_digest(path, size):
+    with open(path, 'rb') as f:
+        f.seek(max(0, size - INDEX_TAIL_SIZE))
+        return hashlib.sha1(f.read(min(size, INDEX_TAIL_SIZE))).hexdigest()
+
+def html_to_text(html):
+    text = re.sub(r'(?is)<(script|style)[^>]*>.*?</\1>', ' ', html)
+    text = re.sub(r'(?s)<[^>]+>', ' ', text)
+    return html_unescape(text)
+
+def message_search_fields(msg, source=None):
+    """Поля полнотекстового индекса из разобранного письма (email.message)"""
+    body = []
+    html = []
+    attachments = []
+    for part in msg.walk():
+        if part.is_multipart():
+            continue
+        filename = part.get_filename()
+        disposition = str(part.get("Content-Disposition", "")).lower()
+        if filename or "attachment" in disposition:
+            attachments.append(decode_header_safe(filename or "", source))
+            continue
+        content_type = part.get_content_type()
+        if content_type not in ("text/plain", "text/html"):
+            continue
+        payload = part.get_payload(decode=True)
+        if not payload:
+            continue
+        text = decode_bytes(payload[:SEARCH_BODY_LIMIT], part.get_content_charset(), source)[0]
+        (body if content_type == "text/plain" else html).append(text)
+    return {
+        "subject": decode_header_safe(msg.get("Subject", ""), source),
+        "sender": decode_header_safe(msg.get("From", ""), source),
+        "recipients": decode_header_safe(msg.get("To", ""), source),
+        "date": str(msg.get("Date", "") or ""),
+        "body": "\n".join(body) if body else html_to_text("\n".join(html)),
+        "attachments": " ".join(attachments),
+    }
+
+def make_search_query(text):
+    """Запрос FTS5 из строки пользователя: все слова целиком, "слово*" — по началу слова.
+
+    Поиск по началу длинного слова объединяет списки всех подходящих слов
+    и на больших индексах заметно медленнее, поэтому включается только явно.
+    """
+    words = re.findall(r'(\w+)(\*?)', text or "")
+    if not words:
+        return None
+    return " ".join('"' + word.replace('"', '""') + '"' + star for word, star in words)
+
+class SearchIndex:
+    """Полнотекстовый индекс писем (SQLite FTS5), общий для всех папок и ящиков.
+
+    Источник (MSG или MBOX) переиндексируется, только если изменились его
+    размер или время изменения; в дописанном MBOX индексируются только новые
+    письма. Проиндексированный текст хранится в messages (внешнее содержимое
+    FTS5): при переиндексации слова старых писем удаляются из FTS командой
+    'delete' с теми же значениями, что были добавлены.
+    """
+    FLUSH_SIZE = 200
+    SCHEMA_VERSION = 2
+
+    def __init__(self, db_path=SEARCH_DB):
+        import sqlite3
+        self.db = sqlite3.connect(db_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self._transaction():
+            if self.db.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+                # индекс старой схемы (FTS без содержимого) строится заново
+                for table in ("message_text", "messages", "sources"):
+                    self.db.execute(f"DROP TABLE IF EXISTS {table}")
+                self.db.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS sources (
+                    id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL,
+                    size INTEGER, mtime REAL, tail TEXT, complete INTEGER NOT NULL DEFAULT 0)""")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, source_id INTEGER NOT NULL, position INTEGER NOT NULL,
+                    offset INTEGER, length INTEGER, subject TEXT, sender TEXT, recipients TEXT, date TEXT,
+                    body TEXT, attachments TEXT, UNIQUE (source_id, position))""")
+            self.db.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS message_text USING fts5(
+                    subject, sender, recipients, date, body, attachments,
+                    content='messages', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2', prefix='2 3')""")
+        self._pending = []
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def begin_source(self, path):
+        """Начать индексацию источника: (id, первый новый номер письма) или None, если он не менялся"""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        tail = _file_tail_digest(path, st.st_size)
+        with self._transaction():
+            row = self.db.execute("SELECT id, size, mtime, tail, complete FROM sources WHERE path = ?",
+                                  (path,)).fetchone()
+            if row is None:
+                cursor = self.db.execute("INSERT INTO sources (path, size, mtime, tail) VALUES (?, ?, ?, ?)",
+                                         (path, st.st_size, st.st_mtime, tail))
+                return cursor.lastrowid, 0
+            source_id, size, mtime, old_tail, complete = row
+            if size == st.st_size and mtime == st.st_mtime:
+                return None if complete else (source_id, 0)
+            first = 0
+            if complete and size < st.st_size and _file_tail_digest(path, size) == old_tail:
+                last = self.db.execute("SELECT MAX(position) FROM messages WHERE source_id = ?",
+                                       (source_id,)).fetchone()[0]
+                first = (last or 0) + 1
+            else:
+                self.db.execute(
+                    "INSERT INTO message_text (message_text, rowid, subject, sender, recipients, date, body, "
+                    "attachments) SELECT 'delete', id, subject, sender, recipients, date, body, attachments "
+                    "FROM messages WHERE source_id = ?", (source_id,)
+                )
+                self.db.execute("DELETE FROM messages WHERE source_id = ?", (source_id,))
+            self.db.execute("UPDATE sources SET size = ?, mtime = ?, tail = ?, complete = 0 WHERE id = ?",
+                            (st.st_size, st.st_mtime, tail, source_id))
+            return source_id, first
+
+    def add_message(self, source_id, position, fields, offset=None, length=None):
+        self._pending.append((source_id, position, offset, length, fields))
+        if len(self._pending) >= self.FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Записать накопленные письма одной короткой транзакцией"""
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        with self._transaction():
+            for source_id, position, offset, length, fields in pending:
+                text = (fields["subject"], fields["sender"], fields["recipients"],
+                        fields["date"], fields["body"], fields["attachments"])
+                cursor = self.db.execute(
+                    "INSERT OR IGNORE INTO messages (source_id, position, offset, length, subject, sender, "
+                    "recipients, date, body, attachments) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (source_id, position, offset, length) + text
+                )
+                if cursor.rowcount:
+                    self.db.execute(
+                        "INSERT INTO message_text (rowid, subject, sender, recipients, date, body, attachments) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (cursor.lastrowid,) + text
+                    )
+
+    def finish_source(self, source_id):
+        self.flush()
+        self.db.execute("UPDATE sources SET complete = 1 WHERE id = ?", (source_id,))
+
+    def index_mbox(self, mbox_path, should_stop=None):
+        """Проиндексировать MBOX без конвертации; возвращает число добавленных писем"""
+        state = self.begin_source(mbox_path)
+        if state is None:
+            return 0
+        source_id, first = state
+        added = 0
+        position = 0
+        for buf, base, spans in iter_mbox_blocks(mbox_path):
+            for start, end in spans:
+                position += 1
+                if should_stop and should_stop():
+                    self.flush()
+                    return added
+                if position < first:
+                    continue
+                try:
+                    fields = message_search_fields(parse_mbox_entry(buf[start:end]), mbox_path)
+                except Exception as e:
+                    logger.warning(f"Ошибка индексации письма {position} из {mbox_path}: {str(e)}")
+                    continue
+                self.add_message(source_id, position, fields, base + start, end - start)
+                added += 1
+        self.finish_source(source_id)
+        return added
+
+    def index_msg(self, msg_path, msg=None, attachment_names=None):
+        """Проиндексировать MSG (уже открытый объект можно передать в msg).
+
+        attachment_names избавляет от обращения к msg.attachments, которое
+        читает содержимое всех вложений.
+        """
+        state = self.begin_source(msg_path)
+        if state is None:
+            return 0
+        with contextlib.ExitStack() as stack:
+            if msg is None:
+                msg = stack.enter_context(open_msg(msg_path))
+            body = getattr(msg, 'body', None)
+            html = getattr(msg, 'htmlBody', None)
+            if isinstance(body, bytes):
+                body = decode_bytes(body, source=msg_path)[0]
+            if not body and html:
+                body = html_to_text(decode_bytes(html, source=msg_path)[0] if isinstance(html, bytes) else str(html))
+            if attachment_names is not None:
+                attachments = list(attachment_names)
+            else:
+                attachments = [getattr(att, 'longFilename', None) or getattr(att, 'shortFilename', None) or ""
+                               for att in getattr(msg, 'attachments', [])]
+            date = getattr(msg, 'date', None)
+            self.add_message(state[0], 0, {
+                "subject": getattr(msg, 'subject', None) or "",
+                "sender": getattr(msg, 'sender', None) or "",
+                "recipients": getattr(msg, 'to', None) or getattr(msg, 'display_to', None) or "",
+                "date": str(date) if date else "",
+                "body": (body or "")[:SEARCH_BODY_LIMIT],
+                "attachments": " ".join(attachments),
+            })
+        self.finish_source(state[0])
+        return 1
+
+    def index_file(self, path, should_stop=None):
+        if is_mbox_path(path):
+            return self.index_mbox(path, should_stop)
+        if path.lower().endswith(".msg"):
+            return self.index_msg(path)
+        return 0
+
+    def search(self, text, limit=500):
+        """Найденные письма, новые первыми: (путь, номер, смещение, длина, тема, отправитель, дата)"""
+        query = make_search_query(text)
+        if query is None:
+            return []
+        self.flush()
+        return self.db.execute(
+            "SELECT s.path, m.position, m.offset, m.length, m.subject, m.sender, m.date "
+            "FROM message_text JOIN messages m ON m.id = message_text.rowid "
+            "JOIN sources s ON s.id = m.source_id "
+            "WHERE message_text MATCH ? ORDER BY message_text.rowid DESC LIMIT ?",
+            (query, limit)
+        ).fetchall()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.db.close()
+
+def dedup_report(stats):
+    """Сводка экономии от дедупликации по счётчикам конвертера.
+
+    Время считается по всей конвертации письма: дубликат экономит среднее
+    время сконвертированного письма за вычетом того, что ушло на его чтение
+    и сравнение.
+    """
+    converted = stats.get("converted_messages", 0)
+    seconds_per_message = stats.get("converted_seconds", 0.0) / converted if converted else 0.0
+    seconds_saved = stats.get("duplicates", 0) * seconds_per_message - stats.get("duplicate_seconds", 0.0)
+    return {
+        "duplicates": stats.get("duplicates", 0),
+        "bytes_saved": stats.get("duplicate_bytes", 0),
+        "seconds_saved": round(max(seconds_saved, 0.0), 3),
+    }
+
+class ConversionStats(Counter):
+    """Счётчики конвертации, суммируемые между процессами пула.
+
+    Время этапов хранится в ключах "<этап>_seconds" (см. CONVERSION_STAGES;
+    для MSG сериализация потоковая и учитывается в write, письма MBOX
+    копируются без сериализации),
+    объёмы — в read_bytes/written_bytes, полное время писем — в
+    converted_seconds и duplicate_seconds. slowest — самые долгие письма,
+    errors — ошибки отдельных писем, ещё не забранные в отчёт (take_errors).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.slowest = []
+        self.errors = []
+
+    def __reduce__(self):
+        return self.__class__, (dict(self),), {"slowest": self.slowest, "errors": self.errors}
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self[f"{stage}_seconds"] += time.perf_counter() - started
+
+    def record_message(self, source, seconds, duplicate=False):
+        if duplicate:
+            self["duplicate_seconds"] += seconds
+        else:
+            self["converted_seconds"] += seconds
+            self["converted_messages"] += 1
+        self._keep_slowest(seconds, source)
+
+    def _keep_slowest(self, seconds, source):
+        item = (seconds, source)
+        if len(self.slowest) < SLOWEST_LIMIT:
+            heapq.heappush(self.slowest, item)
+        elif item > self.slowest[0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def record_error(self, source, error, message=None, data=None):
+        """Ошибка отдельного письма; data — его байты из MBOX для карантина"""
+        self["message_errors"] += 1
+        entry = {"source": source, "error": str(error)}
+        if message is not None:
+            entry.update(message=message, data=data)
+        self.errors.append(entry)
+
+    def take_errors(self):
+        errors, self.errors = self.errors, []
+        return errors
+
+    def merge(self, other):
+        self.update(other)
+        for seconds, source in getattr(other, "slowest", ()):
+            self._keep_slowest(seconds, source)
+        self.errors.extend(getattr(other, "errors", ()))
+
+    def clear(self):
+        super().clear()
+        self.slowest = []
+        self.errors = []
+
+def progress_estimate(done_bytes, total_bytes, messages, elapsed):
+    """Скорость (писем/с, МБ/с) и оценка оставшегося времени в секундах (None — пока неизвестно)"""
+    if elapsed <= 0:
+        return {"messages_per_s": 0.0, "mb_per_s": 0.0, "eta": None}
+    bytes_per_s = done_bytes / elapsed
+    eta = (total_bytes - done_bytes) / bytes_per_s if bytes_per_s > 0 else None
+    return {
+        "messages_per_s": round(messages / elapsed, 1),
+        "mb_per_s": round(bytes_per_s / (1024 * 1024), 2),
+        "eta": round(max(eta, 0.0), 1) if eta is not None else None,
+    }
+
+class ConversionProgress:
+    """Счётчики обработанных писем и байтов исходников и флаг отмены.
+
+    Счётчики и событие отмены — объекты multiprocessing: процессы пула
+    получают их через initializer и обновляют те же значения. callback
+    вызывается только в создавшем процессе и не чаще раза в interval секунд,
+    чтобы не заваливать сигналами цикл событий интерфейса.
+    """
+
+    def __init__(self, total_bytes=0, callback=None, interval=PROGRESS_INTERVAL):
+        self.total_bytes = total_bytes
+        self.callback = callback
+        self.interval = interval
+        import multiprocessing
+        self._counts = multiprocessing.Array('q', 2)
+        self._cancel = multiprocessing.Event()
+        self.started = time.perf_counter()
+        self._reported = 0.0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["callback"] = None
+        return state
+
+    def add(self, messages, nbytes):
+        with self._counts.get_lock():
+            self._counts[0] += messages
+            self._counts[1] += nbytes
+        if self.callback is not None:
+            self.report()
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def snapshot(self):
+        with self._counts.get_lock():
+            messages, done_bytes = self._counts[0], self._counts[1]
+        estimate = progress_estimate(done_bytes, self.total_bytes, messages,
+                                     time.perf_counter() - self.started)
+        percent = min(100, done_bytes * 100 // self.total_bytes) if self.total_bytes else 0
+        return dict(estimate, messages=messages, done_bytes=done_bytes, percent=percent)
+
+    def report(self, force=False):
+        """Передать снимок в callback, если с прошлого раза прошло interval секунд"""
+        now = time.perf_counter()
+        if self.callback is None or (not force and now - self._reported < self.interval):
+            return
+        self._reported = now
+        self.callback(self.snapshot())
+
+def build_run_report(stats, files, converted, errors, elapsed, output_dir, cancelled=False):
+    """Итоговый отчёт прогона: скорость, время по этапам (суммарно по процессам), медленные письма"""
+    estimate = progress_estimate(stats.get("read_bytes", 0), 0, stats.get("written", 0), elapsed)
+    return {
+        "files": len(files),
+        "converted": converted,
+        "failed": len(errors),
+        "cancelled": cancelled,
+        "errors": errors,
+        "elapsed": round(elapsed, 3),
+        "messages_per_s": estimate["messages_per_s"],
+        "mb_per_s": estimate["mb_per_s"],
+        "read_bytes": stats.get("read_bytes", 0),
+        "written_bytes": stats.get("written_bytes", 0),
+        "write_errors": stats.get("write_errors", 0),
+        "message_errors": stats.get("message_errors", 0),
+        "stages": {stage: round(stats.get(f"{stage}_seconds", 0.0), 3) for stage in CONVERSION_STAGES},
+        "slowest": [{"source": source, "seconds": round(seconds, 3)}
+                    for seconds, source in sorted(getattr(stats, "slowest", ()), reverse=True)],
+        "profiled": stats.get("profiled", 0),
+        "dedup": dedup_report(stats),
+        "output_dir": output_dir,
+    }
+
+def save_run_report(output_dir, report):
+    """Сохранить отчёт в папку результата; возвращает путь к файлу"""
+    report_dir = os.path.join(output_dir, REPORT_DIR)
+    os.makedirs(report_dir, exist_ok=True)
+    path = os.path.join(report_dir, f"run-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+    return path
+
+class ErrorReport:
+    """Ошибки прогона построчно в JSONL рядом с отчётом и, по желанию, копии в карантин.
+
+    В карантин копируются MSG, которые не удалось сконвертировать, и
+    отдельные письма MBOX (каждое — MBOX из одного письма), чтобы их можно
+    было разобрать или сконвертировать повторно. Файл отчёта создаётся при
+    первой ошибке.
+
+    Запись идёт в отдельном потоке пачками, чтобы копирование в карантин не
+    тормозило конвертацию; всё записанное гарантировано только после close().
+    """
+
+    def __init__(self, output_dir, quarantine=False):
+        self.path = os.path.join(output_dir, REPORT_DIR, f"errors-{datetime.now().strftime('%Y%m%d-%H%M%S')}.jsonl")
+        self.quarantine_dir = os.path.join(output_dir, QUARANTINE_DIR) if quarantine else None
+        self.count = 0
+        self._file = None
+        self._names = None
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def add(self, source, error, message=None, data=None):
+        """Поставить ошибку в очередь записи; возвращает запись отчёта.
+
+        Ключ "quarantine" появляется в записи после её записи потоком.
+        """
+        entry = {"time": datetime.now().isoformat(timespec="seconds"), "source": source,
+                 "message": message, "error": str(error)}
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="error-report", daemon=True)
+            self._thread.start()
+        self._queue.put((entry, data))
+        self.count += 1
+        return entry
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in batch:
+                if item is not None:
+                    try:
+                        self._write(*item)
+                    except Exception as e:
+                        logger.error(f"Не удалось записать ошибку в {self.path}: {str(e)}")
+            if self._file is not None:
+                self._file.flush()
+            if None in batch:
+                return
+
+    def _write(self, entry, data):
+        if self.quarantine_dir:
+            try:
+                entry["quarantine"] = self.quarantine(entry["source"], entry["message"], data)
+            except OSError as e:
+                logger.warning(f"Не удалось скопировать {entry['source']} в карантин: {e}")
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def add_stats_errors(self, stats):
+        """Перенести в отчёт ошибки писем, накопленные конвертером"""
+        return [self.add(**entry) for entry in stats.take_errors()]
+
+    def quarantine(self, source, message=None, data=None):
+        """Копия проблемного источника; None, если копировать нечего.
+
+        Письмо MBOX берётся из data, сохранённых при ошибке: сжатый MBOX
+        не распаковывается заново ради каждого письма.
+        """
+        if data is None and not source.lower().endswith(".msg"):
+            return None
+        if self._names is None:
+            os.makedirs(self.quarantine_dir, exist_ok=True)
+            self._names = NameRegistry(os.listdir(self.quarantine_dir))
+        name = os.path.basename(source)
+        for extension in MBOX_EXTENSIONS + (".msg",):
+            if name.lower().endswith(extension):
+                name = name[:-len(extension)]
+                break
+        stem = sanitize_filename(name) or "source"
+        if message is None:
+            path = os.path.join(self.quarantine_dir, self._names.reserve(stem, ".msg"))
+            shutil.copyfile(source, path)
+            return path
+        path = os.path.join(self.quarantine_dir, self._names.reserve(f"{stem}_{message}", ".mbox"))
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def is_profile_sampled(label, rate):
+    """Детерминированная выборка: одно и то же письмо всегда попадает или не попадает в профиль"""
+    if rate <= 0:
+        return False
+    return int(hashlib.md5(label.encode('utf-8', errors='replace')).hexdigest()[:8], 16) < rate * 0x100000000
+
+class NameRegistry:
+    """Занятые имена файлов в папке: содержимое читается один раз, дальше всё в памяти"""
+    def __init__(self, names=()):
+        self.taken = {os.path.normcase(name) for name in names}
+        self.counters = {}
+
+    def reserve(self, stem, extension=".eml"):
+        """Свободное имя вида stem.eml, stem_1.eml, ... за амортизированное O(1)"""
+        counter = self.counters.get(stem, 0)
+        name = f"{stem}{extension}" if counter == 0 else f"{stem}_{counter}{extension}"
+        while os.path.normcase(name) in self.taken:
+            counter += 1
+            name = f"{stem}_{counter}{extension}"
+        self.counters[stem] = counter + 1
+        self.taken.add(os.path.normcase(name))
+        return name
+
+def layout_subdir(layout, stem, date_value=None):
+    """Подпапка результата: '' (flat), ГГГГ/ММ (date) или две hex-цифры хэша имени (hash)"""
+    if layout == "date":
+        try:
+            if not isinstance(date_value, datetime):
+                date_value = parsedate_to_datetime(str(date_value))
+            return os.path.join(f"{date_value.year:04d}", f"{date_value.month:02d}")
+        except (TypeError, ValueError, IndexError, AttributeError):
+            return "unknown_date"
+    if layout == "hash":
+        return hashlib.sha1(stem.encode('utf-8', errors='surrogateescape')).hexdigest()[:2]
+    return ""
+
+class ContainerCheckpoint:
+    """Последнее завершённое состояние файла-контейнера (zip, tar, mbox): файл <путь>.checkpoint.
+
+    Запоминаются смещение, с которого следующий сеанс начнёт дописывать, и
+    байты после него (центральный каталог zip, конец tar-архива). Если сеанс
+    оборвался, не закрыв приёмник, restore() возвращает файл к этому
+    состоянию: письма оборванного сеанса не попали в журнал и будут записаны заново.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state_path = path + ".checkpoint"
+
+    def restore(self):
+        """Откатить незавершённый сеанс записи; без контрольной точки файл не меняется"""
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            offset, tail = state["offset"], base64.b64decode(state["tail"])
+        except (OSError, ValueError, KeyError):
+            return
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = -1
+        if size < offset:
+            # файл удалён или заменён: контрольная точка к нему не относится
+            os.remove(self.state_path)
+            return
+        with open(self.path, 'r+b') as f:
+            if size == offset + len(tail):
+                f.seek(offset)
+                if f.read(len(tail)) == tail:
+                    return
+            logger.warning(f"Незавершённая запись в {self.path} отброшена: письма будут записаны заново")
+            f.truncate(offset)
+            f.seek(offset)
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def save(self, offset):
+        """Запомнить текущее состояние файла, сбросив его на диск"""
+        fsync_paths([self.path])
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            tail = f.read()
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"offset": offset, "tail": base64.b64encode(tail).decode('ascii')}, f)
+        fsync_paths([tmp_path])
+        os.replace(tmp_path, self.state_path)
+
+class DirectorySink:
+    """Каждое письмо — отдельный файл .eml в папке результата.
+
+    Все приёмники: open(name) отдаёт (файл, итоговое расположение письма);
+    parallel_safe — можно ли писать в него из нескольких процессов;
+    finalized_on_close — письма становятся читаемыми только после close()
+    (архивы и общий MBOX), поэтому журнал отмечает их готовыми лишь тогда.
+    """
+    parallel_safe = True
+    finalized_on_close = False
+    # путь известен до записи (location), файлы можно писать из нескольких потоков
+    thread_safe = True
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self._created_dirs = set()
+        self._replaceable = set()
+
+    def allow_replace(self, name):
+        """Разрешить перезапись файла: его оставило это же письмо в оборванном запуске"""
+        self._replaceable.add(name)
+
+    def _ensure_dir(self, path):
+        directory = os.path.dirname(path)
+        if directory not in self._created_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self._created_dirs.add(directory)
+
+    @contextlib.contextmanager
+    def open(self, name):
+        """Новый файл письма; существующий файл не перезаписывается.
+
+        Файл создаётся атомарно (режим 'x'): если имя уже занял другой
+        процесс пула, письмо получает name_1.eml, name_2.eml, ...
+        Перезаписываются только имена из allow_replace(). При ошибке записи
+        недописанный файл удаляется.
+        """
+        path = self.location(name)
+        self._ensure_dir(path)
+        stem, extension = os.path.splitext(name)
+        counter = 0
+        while True:
+            try:
+                f = open(path, 'wb' if name in self._replaceable else 'xb')
+                break
+            except FileExistsError:
+                counter += 1
+                path = self.location(f"{stem}_{counter}{extension}")
+        try:
+            with f:
+                yield f, path
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+            raise
+
+    def location(self, name):
+        return os.path.join(self.output_dir, name)
+
+    def existing_names(self, subdir):
+        try:
+            return os.listdir(os.path.join(self.output_dir, subdir))
+        except OSError:
+            return []
+
+    def close(self):
+        pass
+
+class ZipSink:
+    """Все письма дописываются в один ZIP-архив"""
+    parallel_safe = False
+    finalized_on_close = True
+
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        import zipfile
+        os.makedirs(os.path.dirname(archive_path) or ".", exist_ok=True)
+        self.checkpoint = ContainerCheckpoint(archive_path)
+        self.checkpoint.restore()
+        self.archive = zipfile.ZipFile(archive_path, 'a', zipfile.ZIP_DEFLATED, compresslevel=1)
+        # новые записи ложатся на место центрального каталога
+        self.checkpoint.save(self.archive.start_dir)
+
+    @contextlib.contextmanager
+    def open(self, name):
+        with self.archive.open(name.replace(os.sep, '/'), 'w', force_zip64=True) as f:
+            yield f, self.location(name)
+
+    def location(self, name):
+        return f"{self.archive_path}:{name.replace(os.sep, '/')}"
+
+    def existing_names(self, subdir):
+        prefix = subdir.replace(os.sep, '/') + '/' if subdir else ''
+        return [n[len(prefix):] for n in self.archive.namelist()
+                if n.startswith(prefix) and '/' not in n[len(prefix):]]
+
+    def close(self):
+        offset = self.archive.start_dir
+        self.archive.close()
+        self.checkpoint.save(offset)
+
+class TarSink:
+    """Все письма дописываются в один tar-архив (размер записи нужен заранее,
+    поэтому письмо сначала пишется во временный буфер)"""
+    parallel_safe = False
+    finalized_on_close = True
+
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        import tarfile
+        os.makedirs(os.path.dirname(archive_path) or ".", exist_ok=True)
+        self.checkpoint = ContainerCheckpoint(archive_path)
+        self.checkpoint.restore()
+        self.archive = tarfile.open(archive_path, 'a')
+        # новые записи ложатся на место нулевых блоков конца архива
+        self.checkpoint.save(self.archive.offset)
+
+    @contextlib.contextmanager
+    def open(self, name):
+        import tarfile
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as spool:
+            yield spool, self.location(name)
+            info = tarfile.TarInfo(name.replace(os.sep, '/'))
+            info.size = spool.tell()
+            info.mtime = int(time.time())
+            spool.seek(0)
+            self.archive.addfile(info, spool)
+
+    def location(self, name):
+        return f"{self.archive_path}:{name.replace(os.sep, '/')}"
+
+    def existing_names(self, subdir):
+        prefix = subdir.replace(os.sep, '/') + '/' if subdir else ''
+        return [n[len(prefix):] for n in self.archive.getnames()
+                if n.startswith(prefix) and '/' not in n[len(prefix):]]
+
+    def close(self):
+        offset = self.archive.offset
+        self.archive.close()
+        self.checkpoint.save(offset)
+
+class MaildirSink:
+    """Maildir: письмо пишется в tmp/ и атомарно переносится в new/"""
+    parallel_safe = True
+    finalized_on_close = False
+
+    def __init__(self, maildir_path):
+        self.maildir_path = maildir_path
+        for subdir in ("tmp", "new", "cur"):
+            os.makedirs(os.path.join(maildir_path, subdir), exist_ok=True)
+        import socket
+        self.hostname = socket.gethostname().replace('/', '\\057').replace(':', '\\072')
+        self.counter = 0
+
+    @contextlib.contextmanager
+    def open(self, name):
+        self.counter += 1
+        unique = f"{int(time.time())}.M{time.time_ns() % 1000000}P{os.getpid()}Q{self.counter}.{self.hostname}"
+        tmp_path = os.path.join(self.maildir_path, "tmp", unique)
+        path = os.path.join(self.maildir_path, "new", unique)
+        with open(tmp_path, 'wb') as f:
+            yield f, path
+        os.replace(tmp_path, path)
+
+    def existing_names(self, subdir):
+        return []
+
+    def close(self):
+        pass
+
+class MboxSink:
+    """Все письма дописываются в один MBOX (строки From экранируются по mboxrd)"""
+    parallel_safe = False
+    finalized_on_close = True
+
+    def __init__(self, mbox_path):
+        self.mbox_path = mbox_path
+        os.makedirs(os.path.dirname(mbox_path) or ".", exist_ok=True)
+        self.checkpoint = ContainerCheckpoint(mbox_path)
+        self.checkpoint.restore()
+        self.file = open(mbox_path, 'ab')
+        self.checkpoint.save(self.file.tell())
+
+    @contextlib.contextmanager
+    def open(self, name):
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as spool:
+            yield spool, self.location(name)
+            spool.seek(0)
+            line = b'\n'
+            self.file.write(f"From MAILER-DAEMON {time.asctime(time.gmtime())}\n".encode('ascii'))
+            for line in spool:
+                line = line.replace(b'\r\n', b'\n')
+                if line.lstrip(b'>').startswith(b'From '):
+                    line = b'>' + line
+                self.file.write(line)
+            if not line.endswith(b'\n'):
+                self.file.write(b'\n')
+            self.file.write(b'\n')
+
+    def location(self, name):
+        return f"{self.mbox_path}:{name}"
+
+    def existing_names(self, subdir):
+        return []
+
+    def close(self):
+        self.file.close()
+        self.checkpoint.save(os.path.getsize(self.mbox_path))
+
+def fsync_paths(paths):
+    """Сбросить файлы на диск, а затем по одному разу их папки"""
+    directories = set()
+    for path in paths:
+        fd = os.open(path, os.O_RDWR)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        directories.add(os.path.dirname(path))
+    if hasattr(os, "O_DIRECTORY"):
+        for directory in directories:
+            fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+class WriterPool:
+    """Потоки записи готовых писем в приёмник с ограниченной по объёму очередью.
+
+    submit() блокируется, пока в очереди и в записи больше max_bytes данных
+    (обратное давление): разбор следующих писем идёт одновременно с записью,
+    а память ограничена. Поток берёт письма пачками до WRITE_BATCH, но каждое
+    письмо — отдельный файл (open/write/close): пул работает только с
+    приёмниками thread_safe, то есть с папкой, где склеивать записи некуда.
+    Пачкой выполняется только сброс на диск: при sync файлы пачки после
+    записи сбрасываются вместе, а их папки — по одному разу. Результаты
+    (on_done, путь, байты, секунды, ошибка) забирает вызывающий поток через
+    collect(), поэтому журнал и счётчики обновляются только в нём.
+    """
+
+    def __init__(self, sink, threads=WRITE_THREADS, max_bytes=WRITE_QUEUE_BYTES, sync=False):
+        self.sink = sink
+        self.max_bytes = max_bytes
+        self.sync = sync
+        self._items = deque()
+        self._pending_bytes = 0
+        self._closing = False
+        self._condition = threading.Condition()
+        self._done = deque()
+        self._threads = [threading.Thread(target=self._run, name=f"eml-writer-{n}", daemon=True)
+                         for n in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, name, data, on_done=None):
+        with self._condition:
+            while self._pending_bytes and self._pending_bytes + len(data) > self.max_bytes:
+                self._condition.wait()
+            self._items.append((name, data, on_done))
+            self._pending_bytes += len(data)
+            self._condition.notify_all()
+
+    def _take_batch(self):
+        with self._condition:
+            while not self._items and not self._closing:
+                self._condition.wait()
+            return [self._items.popleft() for _ in range(min(WRITE_BATCH, len(self._items)))]
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+            results = []
+            for name, data, on_done in batch:
+                started = time.perf_counter()
+                try:
+                    with self.sink.open(name) as (f, location):
+                        f.write(data)
+                    results.append([on_done, location, len(data), 0.0, None])
+                except Exception as e:
+                    results.append([on_done, self.sink.location(name), len(data), 0.0, e])
+                results[-1][3] = time.perf_counter() - started
+            if self.sync:
+                started = time.perf_counter()
+                try:
+                    fsync_paths([result[1] for result in results if result[4] is None])
+                except OSError as e:
+                    logger.warning(f"Не удалось сбросить файлы на диск: {e}")
+                results[-1][3] += time.perf_counter() - started
+            self._done.extend(tuple(result) for result in results)
+            with self._condition:
+                self._pending_bytes -= sum(len(data) for _name, data, _on_done in batch)
+                self._condition.notify_all()
+
+    def collect(self):
+        """Завершённые записи на текущий момент"""
+        done = []
+        while self._done:
+            done.append(self._done.popleft())
+        return done
+
+    def close(self):
+        """Дождаться записи всей очереди и остановить потоки; возвращает оставшиеся результаты"""
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        return self.collect()
+
+# приёмник и его файл (папка) внутри папки результата
+SINKS = {
+    "directory": (DirectorySink, None),
+    "zip": (ZipSink, "messages.zip"),
+    "tar": (TarSink, "messages.tar"),
+    "maildir": (MaildirSink, "Maildir"),
+    "mbox": (MboxSink, "messages.mbox"),
+}
+
+def sink_class(kind):
+    return SINKS.get(kind, SINKS["directory"])[0]
+
+def make_sink(kind, output_dir):
+    """Приёмник результата по имени из настроек (файлы архивов — в папке результата)"""
+    cls, name = SINKS.get(kind, SINKS["directory"])
+    return cls(os.path.join(output_dir, name) if name else output_dir)
+
+class MessageConverter:
+    def generate_safe_filename(self, original_path, new_extension):
+        base_name = os.path.splitext(os.path.basename(original_path))[0]
+        safe_name = sanitize_filename(base_name)
+        
+        if not safe_name:
+            safe_name = "converted_message"
+        
+        return safe_name + new_extension
+
+    def parse_msg_date(self, date_obj):
+        """Парсинг даты из MSG объекта"""
+        if date_obj is None:
+            return datetime.now()
+            
+        if isinstance(date_obj, datetime):
+            return date_obj
+            
+        if isinstance(date_obj, str):
+            try:
+                for fmt in ['%a, %d %b %Y %H:%M:%S %z', '%d %b %Y %H:%M:%S', '%Y-%m-%d %H:%M:%S']:
+                    try:
+                        return datetime.strptime(date_obj, fmt)
+                    except ValueError:
+                        continue
+            except:
+                pass
+        
+        return datetime.now()
+
+    def process_html_with_inline_images(self, html, inline_attachments, cid_mapping):
+
+        if not html or not inline_attachments:
+            return html
+
+        if isinstance(html, bytes):
+            html = html.decode('utf-8', errors='replace')
+
+        by_cid = attachment_cid_map(inline_attachments)
+
+        def repl(match):
+            # группа — значение после "cid:"
+            cid = match.group(1).strip('<>')
+            att = by_cid.get(cid)
+            if att is not None:
+                filename = (getattr(att, 'longFilename', None) or 
+                        getattr(att, 'shortFilename', None) or 
+                        f"image_{hashlib.md5(cid.encode()).hexdigest()[:8]}")
+                
+                cid_mapping[filename] = cid
+                
+                return f'src="cid:{cid}"'
+            
+            return match.group(0)
+
+        return re.sub(r'src=["\']cid:([^"\']+)["\']', repl, html, flags=re.IGNORECASE)
+
+    def is_inline_attachment(self, attachment):
+
+        try:
+            cid = getattr(attachment, 'cid', None) or getattr(attachment, 'contentId', None)
+            if cid:
+                return True
+                
+            content_disposition = getattr(attachment, 'contentDisposition', '') or ''
+            if 'inline' in content_disposition.lower():
+                return True
+                
+            filename = (getattr(attachment, 'longFilename', None) or 
+                    getattr(attachment, 'shortFilename', None) or '')
+            if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
+                return True
+                
+            mime_type = getattr(attachment, 'mimetype', None)
+            if mime_type and mime_type.startswith('image/'):
+                return True
+                
+        except Exception:
+            pass
+            
+        return False
+
+    def decode_text(self, text, source=None):
+      if text is None:
+            return ""
+        
+      if isinstance(text, bytes):
+            try:
+                return decode_bytes(text, source=source)[0]
+            except Exception:
+                return str(text)
+      else:
+           return str(text)
+
+    def get_safe_recipients(self, recipients):
+
+        if not recipients:
+            return ""
+        
+        recipient_list = []
+        for recipient in recipients:
+            if hasattr(recipient, 'email') and recipient.email:
+                recipient_list.append(recipient.email)
+            elif hasattr(recipient, 'display_name') and recipient.display_name:
+                recipient_list.append(recipient.display_name)
+            elif isinstance(recipient, str):
+                recipient_list.append(recipient)
+            else:
+                try:
+                    recipient_list.append(str(recipient))
+                except:
+                    recipient_list.append("Unknown")
+        
+        return ", ".join(recipient_list)
+
+    def __init__(self, output_dir, workers=1, resume=False, dedup=False, layout="flat",
+                 sink="directory", profile_sample=0.0, search=False, sync_writes=False, memory_cap=0):
+        self.output_dir = output_dir
+        self.workers = workers
+        self.resume = resume
+        self.dedup = dedup
+        self.layout = layout
+        self.sink_kind = sink
+        self._sink = None
+        self._sink_key = None
+        self._registries = {}
+        self.profile_sample = profile_sample
+        self.search = search
+        self.stats = ConversionStats()
+        self._profiler = None
+        self._journal = None
+        self._journal_dir = None
+        self._dedup_store = None
+        self._search_index = None
+        self._search_sources = {}
+        self.sync_writes = sync_writes
+        self._writer = None
+        self.progress = None
+        self.memory_cap = memory_cap
+
+    @property
+    def journal(self):
+        if not self.resume:
+            return None
+        if self._journal is None or self._journal_dir != self.output_dir:
+            self._journal = ConversionJournal(self.output_dir)
+            self._journal_dir = self.output_dir
+        self._journal.deferred = sink_class(self.sink_kind).finalized_on_close
+        return self._journal
+
+    @property
+    def dedup_store(self):
+        if not self.dedup:
+            return None
+        if self._dedup_store is None:
+            self._dedup_store = DedupStore(self.output_dir)
+        return self._dedup_store
+
+    @property
+    def search_index(self):
+        if not self.search:
+            return None
+        if self._search_index is None:
+            self._search_index = SearchIndex()
+        return self._search_index
+
+    def search_source(self, path):
+        """Состояние индексации источника для поиска: (id, первый новый номер) или None"""
+        index = self.search_index
+        if index is None:
+            return None
+        path = os.path.abspath(path)
+        if path not in self._search_sources:
+            self._search_sources[path] = index.begin_source(path)
+        return self._search_sources[path]
+
+    def finish_search_source(self, path):
+        state = self.search_source(path)
+        if state is not None:
+            self.search_index.finish_source(state[0])
+            self._search_sources[os.path.abspath(path)] = None
+
+    @property
+    def sink(self):
+        key = (self.sink_kind, self.output_dir)
+        if self._sink is None or self._sink_key != key:
+            self.flush_writes()
+            self._close_sink()
+            self._sink = make_sink(self.sink_kind, self.output_dir)
+            self._sink_key = key
+            self._registries = {}
+        return self._sink
+
+    @property
+    def parallel_safe(self):
+        return sink_class(self.sink_kind).parallel_safe
+
+    @property
+    def cancelled(self):
+        return self.progress is not None and self.progress.cancelled
+
+    def report_progress(self, messages, nbytes):
+        if self.progress is not None:
+            self.progress.add(messages, nbytes)
+
+    @property
+    def writer(self):
+        """Пул потоков записи; None, если приёмник пишется только последовательно"""
+        sink = self.sink
+        if not getattr(sink, "thread_safe", False):
+            return None
+        if self._writer is None or self._writer.sink is not sink:
+            self.flush_writes()
+            self._writer = WriterPool(sink, sync=self.sync_writes)
+        return self._writer
+
+    def write_output(self, name, data, on_done=None):
+        """Записать готовое письмо: через пул потоков или сразу.
+
+        on_done(путь) вызывается в этом потоке после записи: сразу или из
+        collect_writes()/flush_writes(). Возвращает путь результата; при записи
+        через пул это ожидаемый путь, а итоговый (если имя успел занять другой
+        процесс) получает on_done.
+        """
+        writer = self.writer
+        if writer is not None:
+            writer.submit(name, data, on_done)
+            self.collect_writes()
+            return self.sink.location(name)
+        started = time.perf_counter()
+        with self.sink.open(name) as (f, location):
+            f.write(data)
+        self._finish_write(on_done, location, len(data), time.perf_counter() - started, None)
+        return location
+
+    def _finish_write(self, on_done, location, size, seconds, error):
+        self.stats["write_seconds"] += seconds
+        if error is not None:
+            self.stats["write_errors"] += 1
+            self.stats.record_error(location, error)
+            logger.error(f"Ошибка записи {location}: {str(error)}")
+            return
+        self.stats["written"] += 1
+        self.stats["written_bytes"] += size
+        if on_done:
+            on_done(location)
+
+    def collect_writes(self):
+        if self._writer is not None:
+            for result in self._writer.collect():
+                self._finish_write(*result)
+
+    def flush_writes(self):
+        """Дождаться записи всех отправленных в пул писем"""
+        if self._writer is not None:
+            writer, self._writer = self._writer, None
+            for result in writer.close():
+                self._finish_write(*result)
+
+    def close(self):
+        """Закрыть приёмник, журнал и хранилище дубликатов; при следующем обращении они будут открыты заново"""
+        self.flush_writes()
+        self.dump_profile()
+        self._close_sink()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if self._dedup_store is not None:
+            self._dedup_store.close()
+            self._dedup_store = None
+        if self._search_index is not None:
+            self._search_index.close()
+            self._search_index = None
+        self._search_sources = {}
+
+    def _close_sink(self):
+        """Закрыть приёмник и только после этого записать отложенные записи журнала"""
+        if self._sink is not None:
+            sink, self._sink = self._sink, None
+            sink.close()
+        if self._journal is not None:
+            self._journal.commit()
+
+    def take_stats(self):
+        """Забрать накопленные счётчики (для передачи из процесса пула)"""
+        self.flush_writes()
+        stats, self.stats = self.stats, ConversionStats()
+        return stats
+
+    def is_duplicate(self, key, owner, size):
+        store = self.dedup_store
+        if store is None or store.claim(key, owner):
+            return False
+        self.stats["duplicates"] += 1
+        self.stats["duplicate_bytes"] += size
+        return True
+
+    def worker_options(self):
+        """Параметры для создания такого же конвертера в процессе пула"""
+        return {"output_dir": self.output_dir, "resume": self.resume, "dedup": self.dedup,
+                "layout": self.layout, "sink": self.sink_kind, "profile_sample": self.profile_sample,
+                "search": self.search, "sync_writes": self.sync_writes, "memory_cap": self.memory_cap}
+
+    @contextlib.contextmanager
+    def profiled(self, label):
+        """Профилирование cProfile для выборки писем (доля profile_sample).
+
+        Профиль накапливается в одном cProfile.Profile и сохраняется в
+        REPORT_DIR/profile-<pid>.prof один раз, при close().
+        """
+        if not is_profile_sampled(label, self.profile_sample):
+            yield
+            return
+        if self._profiler is None:
+            import cProfile
+            self._profiler = cProfile.Profile()
+        self._profiler.enable()
+        try:
+            yield
+        finally:
+            self._profiler.disable()
+            self.stats["profiled"] += 1
+
+    def dump_profile(self):
+        """Сохранить накопленный профиль в REPORT_DIR/profile-<pid>.prof"""
+        if self._profiler is None:
+            return
+        report_dir = os.path.join(self.output_dir, REPORT_DIR)
+        os.makedirs(report_dir, exist_ok=True)
+        self._profiler.dump_stats(os.path.join(report_dir, f"profile-{os.getpid()}.prof"))
+
+    def message_name(self, stem, date_value=None, extension=".eml", claim=None):
+        """Свободное имя письма в приёмнике с учётом раскладки по подпапкам.
+
+        Совпадающие имена получают суффикс _1, _2, ... Реестр знает имена
+        своего процесса; гонку с другими процессами пула решает приёмник-папка,
+        создавая файл атомарно.
+        claim — (sha256 источника, номер письма или None) для журнала: имя
+        запоминается до записи, и после сбоя письмо перезаписывает свой файл,
+        а не получает рядом новое имя.
+        """
+        journal = self.journal if claim and claim[0] else None
+        if journal:
+            name = journal.claimed_name(*claim)
+            if name is not None:
+                allow_replace = getattr(self.sink, "allow_replace", None)
+                if allow_replace:
+                    allow_replace(name)
+                return name
+        subdir = layout_subdir(self.layout, stem, date_value)
+        registry = self._registries.get(subdir)
+        if registry is None:
+            names = list(self.sink.existing_names(subdir))
+            if self.journal:
+                # имена, занятые письмами оборванного запуска, даже если файлов нет
+                names += self.journal.claimed_names(subdir)
+            registry = self._registries[subdir] = NameRegistry(names)
+        name = registry.reserve(stem, extension)
+        name = os.path.join(subdir, name) if subdir else name
+        if journal:
+            journal.record_claim(claim[0], claim[1], name)
+        return name
+
+    def source_digest(self, path):
+        journal = self.journal
+        return journal.source_digest(path) if journal else file_sha256(path)
+
+    def encode_header(self, text):
+        if not text:
+            return ""
+        try:
+            if isinstance(text, bytes):
+                text = text.decode('utf-8', errors='replace')
+            if any(ord(c) > 127 for c in text):
+                from email.header import Header
+                return str(Header(text, 'utf-8'))
+            return text
+        except Exception as e:
+            logger.error(f"Ошибка кодирования заголовка: {e}")
+            return str(text)
+
+    def convert_msg_to_eml(self, msg_path):
+        try:
+            journal = self.journal
+            digest = self.source_digest(msg_path)
+            if journal and journal.is_source_done(digest):
+                logger.info(f"Пропуск уже сконвертированного файла: {msg_path}")
+                return journal.source_output(digest)
+
+            started = time.perf_counter()
+            with self.profiled(msg_path), contextlib.ExitStack() as stack:
+                with self.stats.timer("read"):
+                    # при лимите памяти вложения читаются из OLE по одному, а не все при открытии
+                    msg = stack.enter_context(open_msg(msg_path, delayAttachments=bool(self.memory_cap)))
+                self.stats["read_bytes"] += _file_size(msg_path)
+                out_path = self.convert_msg_object(msg, msg_path, digest)
+            self.stats.record_message(msg_path, time.perf_counter() - started, duplicate=out_path is None)
+            return out_path
+
+        except Exception as e:
+            logger.error(f"Ошибка конвертации MSG файла {msg_path}: {str(e)}")
+            raise
+
+    def convert_msg_object(self, msg, msg_path, digest):
+        """Собирает EML из уже открытого MSG-объекта (или совместимого с ним)."""
+        with contextlib.ExitStack() as spools:
+            return self._convert_msg_object(msg, msg_path, digest, spools)
+
+    def _convert_msg_object(self, msg, msg_path, digest, spools):
+        journal = self.journal
+        decode_started = time.perf_counter()
+        msg_sender = getattr(msg, 'sender', None) or ""
+        recipients = getattr(msg, 'recipients', None)
+        if recipients is None:
+          recipients = getattr(msg, 'to', None) or getattr(msg, 'display_to', None)
+        msg_to = self.get_safe_recipients(recipients) if recipients else ""
+        msg_subject = getattr(msg, 'subject', None) or ""
+        msg_body = self.decode_text(getattr(msg, 'body', None), msg_path)
+        msg_html = self.decode_text(getattr(msg, 'htmlBody', None), msg_path)
+        self.stats["decode_seconds"] += time.perf_counter() - decode_started
+
+        if self.memory_cap:
+            attachments = self.spool_msg_attachments(msg, msg_path, spools)
+        else:
+            attachments = getattr(msg, 'attachments', [])
+        if self.dedup:
+            key = message_dedup_key(
+                getattr(msg, 'messageId', None),
+                [msg_body, msg_html] + [getattr(att, 'data', None) for att in attachments
+                                        if isinstance(getattr(att, 'data', None), (bytes, str))
+                                        or hasattr(getattr(att, 'data', None), 'read')]
+            )
+            if self.is_duplicate(key, os.path.abspath(msg_path), _file_size(msg_path)):
+                logger.info(f"Пропуск дубликата: {msg_path}")
+                return None
+
+        mime_started = time.perf_counter()
+        inline_attachments = []
+        regular_attachments = []
+        cid_mapping = {} 
+        streams = {}
+
+        for att in attachments:
+            if self.is_inline_attachment(att):
+                inline_attachments.append(att)
+            else:
+                regular_attachments.append(att)
+
+        if msg_html and inline_attachments:
+            msg_html = self.process_html_with_inline_images(msg_html, inline_attachments, cid_mapping)
+
+        if not msg_body and not msg_html:
+            outer = email.mime.text.MIMEText("", "plain", "utf-8")
+        elif msg_html and not msg_body:
+            if inline_attachments:
+                outer = MIMEMultipart("related")
+                html_part = MIMEText(msg_html, "html", "utf-8")
+                outer.attach(html_part)
+                
+                for att in inline_attachments:
+                    self.process_inline_attachment(att, outer, cid_mapping, streams)
+            else:
+                outer = MIMEText(msg_html, "html", "utf-8")
+        elif msg_body and not msg_html:
+            outer = MIMEText(msg_body, "plain", "utf-8")
+        else:
+            if inline_attachments:
+                outer = MIMEMultipart("alternative")
+                
+                text_part = MIMEText(msg_body, "plain", "utf-8")
+                outer.attach(text_part)
+                
+                html_related = MIMEMultipart("related")
+                html_part = MIMEText(msg_html, "html", "utf-8")
+                html_related.attach(html_part)
+                
+                for att in inline_attachments:
+                    self.process_inline_attachment(att, html_related, cid_mapping, streams)
+                
+                outer.attach(html_related)
+            else:
+                outer = MIMEMultipart("alternative")
+                outer.attach(MIMEText(msg_body, "plain", "utf-8"))
+                outer.attach(MIMEText(msg_html, "html", "utf-8"))
+
+        if regular_attachments:
+            if isinstance(outer, MIMEMultipart):
+                mixed_outer = MIMEMultipart("mixed")
+                for key, value in outer.items():
+                    mixed_outer[key] = value
+                mixed_outer.attach(outer)
+            else:
+                mixed_outer = MIMEMultipart("mixed")
+                for key, value in outer.items():
+                    mixed_outer[key] = value
+                mixed_outer.attach(outer)
+            
+            outer = mixed_outer
+
+            for att in regular_attachments:
+                try:
+                    self.process_regular_attachment(att, outer, streams)
+                except Exception as e:
+                    logger.warning(f"Ошибка при обработке вложения: {str(e)}")
+                    continue
+
+        outer["Subject"] = msg_subject
+        outer["From"] = msg_sender
+        outer["To"] = msg_to
+        outer["Message-ID"] = f"<{digest[:32]}@converted.local>"
+        
+        msg_date = None
+        if hasattr(msg, 'date') and msg.date:
+            msg_date = self.parse_msg_date(msg.date)
+        else:
+            for attr in ['creationTime', 'lastModificationTime', 'receivedTime']:
+                if hasattr(msg, attr):
+                    attr_value = getattr(msg, attr)
+                    if attr_value:
+                        msg_date = self.parse_msg_date(attr_value)
+                        break
+
+        if not msg_date:
+            msg_date = datetime.now()
+
+        try:
+            formatted_date = formatdate(msg_date.timestamp(), localtime=True)
+        except:
+            formatted_date = formatdate(time.time(), localtime=True)
+
+        outer["Date"] = formatted_date
+
+        outer["MIME-Version"] = "1.0"
+
+        out_name = self.message_name(self.generate_safe_filename(msg_path, ""), msg_date, claim=(digest, None))
+        self.stats["mime_seconds"] += time.perf_counter() - mime_started
+        
+        def written(path):
+            if journal:
+                journal.record_source(digest, msg_path, path)
+
+        # небольшие письма собираются в памяти и уходят в пул записи,
+        # большие потоково пишутся сразу, чтобы не держать вложения в памяти
+        streamed_size = sum(_source_size(data) for data in streams.values())
+        if self.writer is not None and streamed_size <= SPOOL_MAX_SIZE:
+            with self.stats.timer("mime"):
+                buffer = io.BytesIO()
+                f = io.TextIOWrapper(buffer, encoding="utf-8", newline='\n')
+                StreamingEmlWriter(f, streams).write(outer)
+                f.flush()
+                f.detach()
+            out_path = self.write_output(out_name, buffer.getvalue(), written)
+        else:
+            write_started = time.perf_counter()
+            with self.sink.open(out_name) as (raw, out_path):
+                counter = ByteCounter(raw)
+                f = io.TextIOWrapper(counter, encoding="utf-8", newline='\n')
+                StreamingEmlWriter(f, streams).write(outer)
+                f.flush()
+                f.detach()
+            self.stats["written"] += 1
+            self.stats["written_bytes"] += counter.count
+            self.stats["write_seconds"] += time.perf_counter() - write_started
+            written(out_path)
+
+        if self.search:
+            self.search_index.index_msg(msg_path, msg, [
+                getattr(att, 'longFilename', None) or getattr(att, 'shortFilename', None) or ""
+                for att in attachments])
+        logger.info(f"Успешно конвертирован: {msg_path} -> {out_path}")
+        return out_path
+
+    def spool_msg_attachments(self, msg, msg_path, spools):
+        """Вложения MSG с лимитом памяти на письмо (memory_cap).
+
+        Вложения читаются из OLE по одному; те, что не умещаются в лимит,
+        копируются во временные файлы, не загружаясь в память целиком.
+        OLE-файл и временные файлы закрывает spools.
+        """
+        try:
+            import olefile
+            ole = spools.enter_context(olefile.OleFileIO(msg_path))
+        except (ImportError, OSError) as e:
+            logger.info(f"Вложения {msg_path} читаются через объект письма без лимита памяти: {str(e)}")
+            return getattr(msg, 'attachments', [])
+        attachments = []
+        in_memory = 0
+        for storage, stream in msg_attachment_streams(ole):
+            att = SpooledAttachment(_ole_string(ole, storage, "3707"), _ole_string(ole, storage, "3704"),
+                                    _ole_string(ole, storage, "370E"), _ole_string(ole, storage, "3712"))
+            size = ole.get_size("/".join(stream))
+            if in_memory + size > self.memory_cap:
+                att.data = spools.enter_context(tempfile.TemporaryFile())
+                copy_ole_stream(ole, stream, att.data)
+                att.data.seek(0)
+                self.stats["spooled_attachments"] += 1
+                self.stats["spooled_bytes"] += size
+            else:
+                att.data = ole.openstream(stream).read()
+                in_memory += size
+            attachments.append(att)
+        return attachments
+
+    def process_inline_attachment(self, att, parent, cid_mapping, streams=None):
+        filename = (getattr(att, 'longFilename', None) or 
+                   getattr(att, 'shortFilename', None) or 
+                   "inline_image")
+        
+        data = getattr(att, 'data', None)
+        if data is None:
+            return
+            
+        if isinstance(data, str):
+            data = data.encode(errors="replace")
+        elif hasattr(data, 'read'):
+            # вложение во временном файле пишется потоково, если это возможно
+            if streams is None:
+                data = data.read()
+        elif not isinstance(data, bytes):
+            data = bytes(data)
+
+        mime_type, _ = mimetypes.guess_type(filename)
+        if mime_type and mime_type.startswith('image/'):
+            maintype, subtype = mime_type.split("/", 1)
+        else:
+            maintype, subtype = "image", "png"
+
+        if hasattr(data, 'read'):
+            attachment = MIMEBase(maintype, subtype)
+            attachment["Content-Transfer-Encoding"] = "base64"
+            streams[id(attachment)] = data
+        elif maintype == "image":
+            attachment = MIMEImage(data, subtype)
+        else:
+            attachment = MIMEBase(maintype, subtype)
+            attachment.set_payload(data)
+            encoders.encode_base64(attachment)
+
+        if filename in cid_mapping:
+            cid = cid_mapping[filename]
+        else:
+            existing_cid = getattr(att, 'cid', None) or getattr(att, 'contentId', None)
+            if existing_cid:
+                cid = existing_cid.strip('<>')
+            else:
+                cid = f"img_{hashlib.md5(filename.encode()).hexdigest()[:8]}"
+        
+        attachment.add_header("Content-ID", f"<{cid}>")
+        attachment.add_header("Content-Disposition", "inline", filename=filename)
+        
+        parent.attach(attachment)
+
+    def process_regular_attachment(self, att, outer, streams=None):
+        """Обработка обычных вложений.
+
+        Если передан streams, содержимое не кодируется сразу, а регистрируется
+        для потоковой записи через StreamingEmlWriter.
+        """
+        filename = (getattr(att, 'longFilename', None) or 
+                   getattr(att, 'shortFilename', None) or 
+                   "attachment")
+        
+        data = getattr(att, 'data', None)
+        if data is None:
+            return
+            
+        if isinstance(data, str):
+            data = data.encode(errors="replace")
+        elif not isinstance(data, (bytes, bytearray, memoryview)) and not hasattr(data, 'read'):
+            data = bytes(data)
+
+        mime_type, _ = mimetypes.guess_type(filename)
+        if mime_type:
+            maintype, subtype = mime_type.split("/", 1)
+        else:
+            maintype, subtype = "application", "octet-stream"
+
+        attachment = MIMEBase(maintype, subtype)
+        if streams is not None:
+            attachment["Content-Transfer-Encoding"] = "base64"
+            attachment.add_header("Content-Disposition", "attachment", filename=filename)
+            streams[id(attachment)] = data
+            outer.attach(attachment)
+            return
+
+        attachment.set_payload(data.read() if hasattr(data, 'read') else bytes(data))
+        encoders.encode_base64(attachment)
+        attachment.add_header("Content-Disposition", "attachment", filename=filename)
+        attachment.add_header("Content-Transfer-Encoding", "base64")
+        outer.attach(attachment)
+    def convert_file(self, file_path):
+        if file_path.lower().endswith(".msg"):
+            try:
+                return self.convert_msg_to_eml(file_path)
+            finally:
+                self.report_progress(1, _file_size(file_path))
+        elif is_mbox_path(file_path):
+            return self.convert_mbox_to_eml(file_path)
+
+    def convert_mbox_to_eml(self, mbox_path):
+        try:
+            journal = self.journal
+            digest = journal.source_digest(mbox_path) if journal else None
+            if journal and journal.is_source_done(digest):
+                logger.info(f"Пропуск уже сконвертированного файла: {mbox_path}")
+                converted = journal.source_output(digest)
+                self.report_progress(len(converted), _file_size(mbox_path))
+                return converted
+
+            message_errors = self.stats["message_errors"]
+            workers = resolve_workers(self.workers) if self.parallel_safe else 1
+            if workers > 1 and should_shard_mbox(mbox_path):
+                converted = self.convert_mbox_parallel(mbox_path, workers, digest)
+            elif is_compressed_mbox(mbox_path):
+                converted = self.convert_mbox_stream(mbox_path, digest)
+            else:
+                with map_mbox(mbox_path) as mm:
+                    converted = self.convert_mbox_spans(mm, 1, split_mbox_spans(mm), digest, mbox_path)
+            if self.cancelled:
+                logger.info(f"Конвертация {mbox_path} остановлена: записано писем {len(converted)}")
+                return converted
+            # с ошибками писем источник не отмечается готовым: повторный запуск
+            # пропустит записанные письма и попробует сбойные ещё раз
+            if journal and self.stats["message_errors"] == message_errors:
+                journal.record_source(digest, mbox_path)
+            self.finish_search_source(mbox_path)
+            return converted
+            
+        except Exception as e:
+            logger.error(f"Ошибка конвертации MBOX файла {mbox_path}: {str(e)}")
+            raise
+
+    def convert_mbox_stream(self, mbox_path, digest=None):
+        """Конвертация сжатого MBOX блоками по мере распаковки, без временного файла"""
+        converted = []
+        first_number = 1
+        with open_mbox(mbox_path) as (stream, raw):
+            for buf, base, spans in iter_mbox_stream_blocks(stream):
+                # прогресс считается в сжатых байтах, как и общий объём файлов
+                ratio = raw.tell() / (base + len(buf))
+                converted.extend(self.convert_mbox_spans(buf, first_number, spans, digest, mbox_path,
+                                                         base, ratio))
+                first_number += len(spans)
+                if self.cancelled:
+                    break
+        return converted
+
+    def convert_mbox_spans(self, buf, first_number, spans, digest=None, source=None, base=0, ratio=1.0):
+        """Конвертация писем MBOX по их границам; нумерация начинается с first_number.
+
+        digest — sha256 MBOX для журнала: уже записанные письма пропускаются.
+        base — смещение buf в (распакованном) MBOX, ratio — доля байтов файла
+        на байт buf для прогресса.
+        Запись идёт через пул потоков (write_output) и завершается до возврата.
+        При отмене обработка прекращается перед очередным письмом.
+        """
+        owner_prefix = os.path.abspath(source or "")
+        journal = self.journal if digest else None
+        search = self.search_source(source) if source else None
+        converted = []
+        unwritten = set()
+        paths = {}
+
+        def written(path, i):
+            unwritten.discard(i)
+            paths[i] = path
+            if journal:
+                journal.record_message(digest, i, path)
+        
+        for i, (start, end) in enumerate(spans, first_number):
+            if self.cancelled:
+                break
+            self.report_progress(1, int((end - start) * ratio))
+            if journal:
+                done_path = journal.message_output(digest, i)
+                if done_path:
+                    converted.append((i, done_path))
+                    continue
+            label = f"{source or 'mbox'}#{i}"
+            try:
+                started = time.perf_counter()
+                with self.profiled(label):
+                    # MIME-дерево не разбирается: имя берётся из заголовков,
+                    # а в EML копируются исходные байты письма
+                    with self.stats.timer("read"):
+                        raw = buf[start:end]
+                        headers = read_mbox_headers(buf, start, end)
+                        data = mbox_entry_bytes(raw)
+                    self.stats["read_bytes"] += end - start
+                    if self.dedup:
+                        key = message_dedup_key(headers.get('Message-ID'), iter_mbox_content_parts(data, source))
+                        if self.is_duplicate(key, f"{owner_prefix}:{i}", end - start):
+                            self.stats.record_message(label, time.perf_counter() - started, duplicate=True)
+                            continue
+                    with self.stats.timer("decode"):
+                        subject = decode_header_safe(headers.get('Subject', ''), source) or f'message_{i}'
+                    safe_name = sanitize_filename(f"{i}_{subject}")
+                    out_name = self.message_name(safe_name, headers.get('Date'), claim=(digest, i))
+
+                    unwritten.add(i)
+                    eml_path = self.write_output(out_name, data, lambda path, i=i: written(path, i))
+                    if search and i >= search[1]:
+                        msg = email.message_from_bytes(data)
+                        self.search_index.add_message(search[0], i, message_search_fields(msg, source),
+                                                      base + start, end - start)
+                self.stats.record_message(label, time.perf_counter() - started)
+                converted.append((i, eml_path))
+            except Exception as e:
+                unwritten.discard(i)
+                logger.error(f"Ошибка конвертации сообщения {i} из MBOX: {str(e)}")
+                self.stats.record_error(source or "mbox", e, i, bytes(buf[start:end]))
+                continue
+
+        self.flush_writes()
+        if search:
+            self.search_index.flush()
+        return [paths.get(i, path) for i, path in converted if i not in unwritten]
+
+    def convert_mbox_parallel(self, mbox_path, workers, digest=None):
+        """Конвертация одного MBOX несколькими процессами по диапазонам писем"""
+        from concurrent.futures import ProcessPoolExecutor
+        plan = plan_mbox_shards(mbox_path, workers * MBOX_SHARDS_PER_WORKER)
+        options = self.worker_options()
+        converted = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(convert_mbox_shard, options, mbox_path, first, spans, digest)
+                       for first, spans in plan]
+            for future in futures:
+                result, stats = future.result()
+                converted.extend(result)
+                self.stats.merge(stats)
+        return converted
+
+def load_config():
+    default_config = {
+        "output_dir": os.path.expanduser("~/EML_Export"),
+        "dark_theme": True,
+        "workers": 0,
+        "resume": True,
+        "dedup": False,
+        "output_layout": "flat",
+        "output_sink": "directory",
+        "profile_sample": 0.0,
+        "search_index": False,
+        "sync_writes": False,
+        "quarantine": False,
+        "msg_memory_cap": 0
+    }
+
+    if os.path.exists(CONFIG_FILE):
+        try:
+            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+                for key in default_config:
+                    if key in config:
+                        default_config[key] = config[key]
+        except Exception as e:
+            logger.error(f"Ошибка загрузки конфигурации: {e}")
+
+    return default_config
+
+def save_config(config):
+    try:
+        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
+            json.dump(config, f, ensure_ascii=False, indent=4)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения конфигурации: {e}")
+
+# строка From_: отправитель и дата в формате asctime (часовой пояс и хвост после года допустимы)
+FROM_LINE_RE = re.compile(rb'From [^\n]*?(?:Mon|Tue|Wed|Thu|Fri|Sat|Sun)[ \t]+'
+                          rb'(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[ \t]+\d{1,2}[ \t]+'
+                          rb'\d{1,2}:\d{2}(?::\d{2})?[^\n]*?\d{4}')
+FROM_LINE_LIMIT = 256
+HEADER_PARSER = BytesHeaderParser()
+HEADER_SCAN_LIMIT = 256 * 1024
+CONTENT_LENGTH_RE = re.compile(rb'^Content-Length:[ \t]*(\d+)[ \t]*\r?$', re.IGNORECASE | re.MULTILINE)
+MBOXRD_FROM_RE = re.compile(rb'^>(>*From )', re.MULTILINE)
+NON_SPACE_RE = re.compile(rb'\S')
+BASE64_ALPHABET = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/='
+BASE64_SPACE = b' \t\r\n\x0b\x0c'
+MBOX_COMPRESSED_EXTENSIONS = (".mbox.gz", ".mbox.xz", ".mbox.bz2", ".mbox.zst")
+MBOX_EXTENSIONS = (".mbox",) + MBOX_COMPRESSED_EXTENSIONS
+MBOX_STREAM_CHUNK = 16 * 1024 * 1024
+MBOX_READ_AHEAD = 2
+
+@contextlib.contextmanager
+def map_mbox(mbox_path):
+    """Отображение MBOX файла в память только для чтения"""
+    with open(mbox_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mm
+        finally:
+            mm.close()
+
+def is_mbox_path(path):
+    return path.lower().endswith(MBOX_EXTENSIONS)
+
+def is_compressed_mbox(path):
+    return path.lower().endswith(MBOX_COMPRESSED_EXTENSIONS)
+
+@contextlib.contextmanager
+def open_mbox(mbox_path):
+    """Последовательное чтение MBOX; сжатые файлы распаковываются на лету без временного файла.
+
+    Отдаёт (поток, исходный файл): позиция исходного файла показывает,
+    сколько сжатых байтов уже прочитано.
+    """
+    with open(mbox_path, 'rb') as raw:
+        name = mbox_path.lower()
+        if name.endswith(".gz"):
+            import gzip
+            stream = gzip.GzipFile(fileobj=raw)
+        elif name.endswith(".xz"):
+            import lzma
+            stream = lzma.LZMAFile(raw)
+        elif name.endswith(".bz2"):
+            import bz2
+            stream = bz2.BZ2File(raw)
+        elif name.endswith(".zst"):
+            try:
+                import zstandard
+            except ImportError as e:
+                raise ImportError(f"Для чтения {mbox_path} нужен пакет zstandard") from e
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, closefd=False)
+        else:
+            yield raw, raw
+            return
+        with stream:
+            yield stream, raw
+
+def _read_ahead(stream, chunk_size, depth=MBOX_READ_AHEAD):
+    """Куски потока, прочитанные заранее в отдельном потоке; в конце — b''.
+
+    gzip, lzma и bz2 распаковывают без GIL, поэтому распаковка идёт
+    одновременно с разбором уже прочитанных писем.
+    """
+    chunks = queue.Queue(depth)
+    stop = threading.Event()
+
+    def read():
+        try:
+            while not stop.is_set():
+                chunk = stream.read(chunk_size)
+                chunks.put(chunk)
+                if not chunk:
+                    return
+        except Exception as e:
+            chunks.put(e)
+
+    thread = threading.Thread(target=read, name="mbox-read-ahead", daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+            if not chunk:
+                return
+    finally:
+        stop.set()
+        while thread.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+def iter_mbox_stream_blocks(stream, chunk_size=MBOX_STREAM_CHUNK):
+    """Блоки потока MBOX из целых писем: (буфер, смещение буфера в потоке, границы писем в буфере).
+
+    Последнее письмо блока может быть прочитано не полностью, поэтому оно
+    переносится в следующий блок; письмо больше блока дочитывается целиком.
+    """
+    carry = b''
+    base = 0
+    parts = []
+    pending = 0
+    wanted = 0
+    for chunk in _read_ahead(stream, chunk_size):
+        parts.append(chunk)
+        pending += len(chunk)
+        # длинное письмо не пересканируется на каждом куске: копим не меньше его длины
+        if chunk and pending < wanted:
+            continue
+        buf = b''.join([carry] + parts)
+        parts = []
+        pending = 0
+        spans = list(split_mbox_spans(buf, partial=bool(chunk)))
+        if chunk and spans:
+            keep = spans.pop()[0]
+        else:
+            keep = len(buf)
+        if spans:
+            yield buf, base, spans
+        carry = buf[keep:]
+        base += keep
+        wanted = 0 if spans else len(carry)
+
+def iter_mbox_blocks(mbox_path):
+    """Блоки MBOX с границами писем: (буфер, смещение буфера, границы писем в буфере).
+
+    Обычный MBOX — один блок, отображённый в память; сжатый — блоки по мере распаковки.
+    """
+    if not is_compressed_mbox(mbox_path):
+        with map_mbox(mbox_path) as mm:
+            yield mm, 0, split_mbox_spans(mm)
+        return
+    with open_mbox(mbox_path) as (stream, _raw):
+        yield from iter_mbox_stream_blocks(stream)
+
+def find_next_separator(buf, pos, end):
+    """Смещение следующей строки-разделителя From_ после pos (или end).
+
+    Как в mailbox.mbox, пустая строка перед разделителем не обязательна:
+    строка "From " без неё считается разделителем, если похожа на From_
+    (отправитель и дата). После пустой строки разделителем считается любая
+    строка "From ", как и раньше.
+    """
+    idx = buf.find(b'\nFrom ', pos, end)
+    while idx != -1:
+        line_start = idx + 1
+        if buf[idx - 1:idx] == b'\n' or buf[idx - 2:idx] == b'\n\r':
+            return line_start
+        if FROM_LINE_RE.match(buf, line_start, min(end, line_start + FROM_LINE_LIMIT)):
+            return line_start
+        idx = buf.find(b'\nFrom ', line_start, end)
+    return end
+
+def _message_end(buf, start, end, partial=False):
+    header_end = find_next_separator(buf, start, end)
+    for blank in (b'\n\n', b'\n\r\n'):
+        idx = buf.find(blank, start, header_end)
+        if idx != -1:
+            header_end = idx
+    match = CONTENT_LENGTH_RE.search(buf, start, header_end)
+    if match:
+        body_start = header_end + (3 if buf[header_end + 1:header_end + 2] == b'\r' else 2)
+        candidate = body_start + int(match.group(1))
+        while candidate < end and buf[candidate:candidate + 1] in (b'\r', b'\n'):
+            candidate += 1
+        if partial and candidate + 5 > end:
+            # конец письма по Content-Length ещё не прочитан
+            return end
+        if candidate == end or (candidate < end and buf[candidate:candidate + 5] == b'From '):
+            return candidate
+    return find_next_separator(buf, start, end)
+
+def split_mbox_spans(buf, start=0, end=None, partial=False):
+    """Границы писем (начало, конец) в байтовом буфере MBOX без декодирования.
+
+    Поддерживаются mboxo/mboxrd; при наличии Content-Length граница берётся из него.
+    partial — буфер обрывается посреди MBOX: письмо, чей Content-Length выходит
+    за конец буфера, продолжается до конца буфера.
+    """
+    end = len(buf) if end is None else end
+    pos = start
+    while pos < end:
+        next_pos = _message_end(buf, pos, end, partial)
+        if NON_SPACE_RE.search(buf, pos, next_pos):
+            yield pos, next_pos
+        pos = next_pos
+
+def iter_mbox_entries(mbox_path):
+    """Потоковое чтение MBOX: по одному письму отдаёт (смещение, сырые байты)"""
+    for buf, base, spans in iter_mbox_blocks(mbox_path):
+        for start, end in spans:
+            yield base + start, buf[start:end]
+
+def mbox_entry_bytes(raw):
+    """Байты письма из записи MBOX: без строки-разделителя From_ и экранирования >From"""
+    if raw.startswith(b'From '):
+        raw = raw.split(b'\n', 1)[1] if b'\n' in raw else b''
+    if b'>From ' in raw:
+        raw = MBOXRD_FROM_RE.sub(rb'\1', raw)
+    return raw
+
+def parse_mbox_entry(raw):
+    """Разбор одного письма из MBOX (строка-разделитель From_ отбрасывается)"""
+    return email.message_from_bytes(mbox_entry_bytes(raw))
+
+def _header_end(buf, start, end):
+    for limit in (min(end, start + HEADER_SCAN_LIMIT), end):
+        found = [idx for idx in (buf.find(b'\n\n', start, limit), buf.find(b'\n\r\n', start, limit))
+                 if idx != -1]
+        if found:
+            return min(found) + 1
+        if limit == end:
+            break
+    return end
+
+def read_mbox_headers(buf, start, end):
+    """Только заголовки письма MBOX: читаются байты до первой пустой строки.
+
+    MIME-дерево не строится, поэтому для списков и фильтров по теме,
+    отправителю и дате читается лишь малая часть файла.
+    """
+    if buf[start:start + 5] == b'From ':
+        line_end = buf.find(b'\n', start, end)
+        start = end if line_end == -1 else line_end + 1
+    return HEADER_PARSER.parsebytes(buf[start:_header_end(buf, start, end)])
+
+def iter_mbox_headers(mbox_path):
+    """Потоковый просмотр MBOX: по одному письму отдаёт (смещение, длина, заголовки)"""
+    for buf, base, spans in iter_mbox_blocks(mbox_path):
+        for start, end in spans:
+            yield base + start, end - start, read_mbox_headers(buf, start, end)
+
+def iter_mbox_messages(mbox_path):
+    """Генератор писем MBOX: в памяти одновременно находится только одно письмо"""
+    for offset, raw in iter_mbox_entries(mbox_path):
+        try:
+            yield parse_mbox_entry(raw)
+        except Exception as e:
+            logger.error(f"Ошибка разбора письма по смещению {offset} в {mbox_path}: {str(e)}")
+
+def read_mbox_range(mbox_path, offset, length):
+    """Сырые байты записи MBOX; в сжатом MBOX смещение — в распакованном потоке"""
+    with open_mbox(mbox_path) as (f, _raw):
+        f.seek(offset)
+        return f.read(length)
+
+def load_mbox_entry_bytes(mbox_path, offset, length):
+    """Байты одного письма MBOX по его смещению и длине (без строки From_)"""
+    return mbox_entry_bytes(read_mbox_range(mbox_path, offset, length))
+
+def load_mbox_message(mbox_path, offset, length):
+    """Чтение и разбор одного письма MBOX по его смещению и длине"""
+    return email.message_from_bytes(load_mbox_entry_bytes(mbox_path, offset, length))
+
+def mbox_index_path(mbox_path):
+    key = hashlib.sha1(os.path.abspath(mbox_path).encode('utf-8', 'surrogateescape')).hexdigest()
+    return os.path.join(INDEX_DIR, f"{key}.json")
+
+def _index_tail_digest(buf, size):
+    return hashlib.sha1(buf[max(0, size - INDEX_TAIL_SIZE):size]).hexdigest()
+
+def build_index_entry(buf, start, end):
+    """Запись индекса: [смещение, длина, тема, отправитель, дата]"""
+    try:
+        headers = read_mbox_headers(buf, start, end)
+        return [start, end - start,
+                decode_header_safe(headers.get("Subject", "")),
+                decode_header_safe(headers.get("From", "")),
+                decode_header_safe(headers.get("Date", ""))]
+    except Exception as e:
+        logger.warning(f"Ошибка индексации письма по смещению {start}: {str(e)}")
+        return [start, end - start, None, None, None]
+
+def read_mbox_index(mbox_path):
+    try:
+        with open(mbox_index_path(mbox_path), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get("version") == INDEX_VERSION:
+            return index
+    except (OSError, ValueError):
+        pass
+    return None
+
+def save_mbox_index(mbox_path, index):
+    index_path = mbox_index_path(mbox_path)
+    try:
+        os.makedirs(INDEX_DIR, exist_ok=True)
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить индекс {index_path}: {e}")
+
+def plan_mbox_index(mbox_path):
+    """Индекс MBOX без чтения заголовков новых писем; возвращает (индекс, актуален_ли_кэш).
+
+    Записи дискового индекса переиспользуются; если в MBOX только дописаны
+    новые письма, индекс достраивается с последнего известного письма.
+    Записи писем, заголовки которых ещё не прочитаны, короче: [смещение, длина]
+    (их дополняет fill_mbox_index). Сжатый MBOX читается только подряд,
+    поэтому его заголовки читаются сразу, за тот же проход.
+    """
+    st = os.stat(mbox_path)
+    index = read_mbox_index(mbox_path)
+    if index and index["size"] == st.st_size and index["mtime"] == st.st_mtime:
+        return index, True
+
+    if is_compressed_mbox(mbox_path):
+        entries = []
+        for buf, base, spans in iter_mbox_blocks(mbox_path):
+            for start, end in spans:
+                entry = build_index_entry(buf, start, end)
+                entry[0] = base + start
+                entries.append(entry)
+        return {
+            "version": INDEX_VERSION,
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+            "tail": None,
+            "entries": entries,
+        }, False
+
+    with map_mbox(mbox_path) as mm:
+        entries = []
+        scan_from = 0
+        if index and index["entries"] and index["size"] < st.st_size:
+            if _index_tail_digest(mm, index["size"]) == index["tail"]:
+                # последнее письмо могло быть дописано, поэтому пересканируем его
+                entries = index["entries"][:-1]
+                scan_from = index["entries"][-1][0]
+                logger.info(f"Достраивание индекса {mbox_path} с позиции {scan_from}")
+        entries.extend([start, end - start] for start, end in split_mbox_spans(mm, scan_from))
+        tail = _index_tail_digest(mm, st.st_size)
+
+    return {
+        "version": INDEX_VERSION,
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        "tail": tail,
+        "entries": entries,
+    }, False
+
+def is_index_entry_loaded(entry):
+    return len(entry) > 2
+
+def fill_mbox_index(mbox_path, entries, rows):
+    """Прочитать заголовки писем с номерами rows; записи заменяются на полные"""
+    with map_mbox(mbox_path) as mm:
+        for row in rows:
+            start, length = entries[row][:2]
+            entries[row] = build_index_entry(mm, start, start + length)
+
+def load_mbox_index(mbox_path):
+    """Индекс писем MBOX с кэшированием на диске.
+
+    Индекс привязан к размеру и времени изменения файла; если в MBOX только
+    дописаны новые письма, индекс достраивается с последнего известного письма.
+    """
+    index, fresh = plan_mbox_index(mbox_path)
+    entries = index["entries"]
+    pending = [row for row, entry in enumerate(entries) if not is_index_entry_loaded(entry)]
+    if pending:
+        fill_mbox_index(mbox_path, entries, pending)
+    if pending or not fresh:
+        save_mbox_index(mbox_path, index)
+    return entries
+
+def filter_index_entries(entries, text):
+    """Номера записей индекса, у которых тема, отправитель или дата содержат text"""
+    needle = text.strip().casefold()
+    if not needle:
+        return list(range(len(entries)))
+    return [row for row, entry in enumerate(entries)
+            if is_index_entry_loaded(entry) and needle in "\n".join(
+                value for value in entry[2:] if value).casefold()]
+
+def safe_mbox_loader(mbox_path):
+    try:
+        return list(iter_mbox_messages(mbox_path))
+    except Exception as e:
+        raise Exception(f"Не удалось загрузить MBOX файл: {str(e)}")
+
+def sanitize_filename(filename):
+    invalid_chars = '<>:"/\\|?*'
+    for char in invalid_chars:
+        filename = filename.replace(char, '_')
+    filename = filename.strip('. ')
+    if len(filename) > 100:
+        filename = filename[:100]
+    if not filename:
+        filename = "no_subject"
+    return filename
+
+def decode_header_safe(header_value, source=None):
+    if not header_value:
+        return ""
+    try:
+        decoded_parts = decode_header(header_value)
+        result = ""
+        for part, encoding in decoded_parts:
+            if isinstance(part, bytes):
+                # unknown-8bit: 8-битный заголовок без MIME-кодирования
+                result += decode_bytes(part, encoding, source)[0]
+            else:
+                result += str(part)
+        return result
+    except:
+        return str(header_value)
+
+class CharsetDetector:
+    """Определение кодировки 8-битного текста: utf-8 или однобайтовая кириллица/латиница.
+
+    Решение принимается по выборке не больше SAMPLE_SIZE байт: каждая
+    кодировка-кандидат оценивается по частым русским буквам и по регистру
+    внутри слов (текст в чужой кодовой странице даёт "ъБСЧЛБ"). Вердикт
+    кэшируется по паре (источник, объявленная кодировка) — письма одного
+    ящика обычно в одной кодировке.
+    """
+    CANDIDATES = ("cp1251", "koi8-r", "cp866", "iso8859-1")
+    # Объявленным кодировкам из этого списка не доверяем: так часто подписан кириллический текст
+    GENERIC = ("ascii", "iso8859-1", "cp1252", "unknown-8bit")
+    SAMPLE_SIZE = 16 * 1024
+    CACHE_SIZE = 4096
+    FREQUENT = "оеаинтсрвл"
+    RARE = "ъэюфщцшжё"
+    WORD_RE = re.compile(rb'[A-Za-z\x80-\xff]+')
+    WRONG_CASE_RE = re.compile(rb'[flr][FuR]')
+    HIGH_BYTES = bytes(range(0x80, 0x100))
+
+    def __init__(self):
+        self._cache = {}
+        self._tables = {encoding: self._class_table(encoding) for encoding in self.CANDIDATES}
+
+    @classmethod
+    def _class_table(cls, encoding):
+        """Таблица для bytes.translate: байт -> класс символа.
+
+        Буквы: f/F — частые русские, r/R — редкие, l/u — прочие (строчные/прописные);
+        p — нейтральные знаки, x — управляющие символы, псевдографика и т.п.
+        """
+        table = bytearray(b' ' * 256)
+        for byte in range(0x80, 0x100):
+            try:
+                char = bytes([byte]).decode(encoding)
+            except UnicodeDecodeError:
+                table[byte] = ord('x')
+                continue
+            category = unicodedata.category(char)
+            if category.startswith('L'):
+                lower = char.lower()
+                if lower in cls.FREQUENT:
+                    letter = 'f' if category == 'Ll' else 'F'
+                elif lower in cls.RARE:
+                    letter = 'r' if category == 'Ll' else 'R'
+                else:
+                    letter = 'l' if category == 'Ll' else 'u'
+                table[byte] = ord(letter)
+            elif category[0] in 'PZ' or char == '№':
+                table[byte] = ord('p')
+            else:
+                table[byte] = ord('x')
+        return bytes(table)
+
+    @staticmethod
+    def _codec_name(charset):
+        if not charset:
+            return None
+        if charset.lower() == 'unknown-8bit':
+            return 'unknown-8bit'
+        try:
+            return codecs.lookup(charset).name
+        except LookupError:
+            return None
+
+    def _words(self, sample):
+        """Слова с 8-битными байтами: чистые (без ASCII-букв) и число 8-битных байтов в смешанных"""
+        pure = []
+        mixed = 0
+        for word in self.WORD_RE.findall(sample):
+            if word.isascii():
+                continue
+            high = word.translate(None, self.HIGH_BYTES)
+            if high:
+                mixed += len(word) - len(high)
+            else:
+                pure.append(word)
+        return b' ' + b' '.join(pure), mixed
+
+    def _score(self, words, encoding):
+        joined, mixed = words
+        classes = joined.translate(self._tables[encoding])
+        # строчная буква перед прописной внутри слова — признак чужой кодовой страницы
+        wrong_case = len(self.WRONG_CASE_RE.findall(classes))
+        score = (2 * (classes.count(b'f') + classes.count(b'F')) + classes.count(b'l') + classes.count(b'u')
+                 - 4 * wrong_case - 3 * classes.count(b'x'))
+        # 8-битные буквы внутри латинских слов бывают только в западноевропейских текстах
+        return score + (2 * mixed if encoding == "iso8859-1" else -2 * mixed)
+
+    @staticmethod
+    def _is_utf8(sample):
+        try:
+            codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+            return True
+        except UnicodeDecodeError:
+            return False
+
+    def _plausible(self, sample, encoding):
+        if encoding == 'utf-8':
+            return self._is_utf8(sample)
+        return self._score(self._words(sample), encoding) > 0
+
+    def _detect(self, sample):
+        if self._is_utf8(sample):
+            return 'utf-8'
+        words = self._words(sample)
+        return max(self.CANDIDATES, key=lambda encoding: self._score(words, encoding))
+
+    def decode(self, data, declared=None, source=None):
+        """Декодирование байтов; возвращает (текст, кодировка)"""
+        data = bytes(data)
+        if data.isascii():
+            return data.decode('ascii'), 'ascii'
+
+        declared = self._codec_name(declared)
+        if declared and declared not in self.GENERIC:
+            try:
+                return data.decode(declared), declared
+            except UnicodeDecodeError:
+                pass
+
+        sample = data[:self.SAMPLE_SIZE]
+        key = (source, declared) if source else None
+        encoding = self._cache.get(key) if key else None
+        if encoding is None or not self._plausible(sample, encoding):
+            encoding = self._detect(sample)
+            if key:
+                if len(self._cache) >= self.CACHE_SIZE:
+                    self._cache.pop(next(iter(self._cache)))
+                self._cache[key] = encoding
+
+        try:
+            return data.decode(encoding), encoding
+        except UnicodeDecodeError:
+            return data.decode(encoding, errors='replace'), encoding
+
+_charset_detector = CharsetDetector()
+
+def decode_bytes(data, declared=None, source=None):
+    """Общая точка декодирования текста писем: (текст, кодировка).
+
+    declared — кодировка из заголовков, source — файл или ящик, к которому
+    привязывается кэш вердикта.
+    """
+    return _charset_detector.decode(data, declared, source)
+
+def resolve_workers(workers):
+    """Число процессов пула: 0 или None — по числу ядер"""
+    if workers and workers > 0:
+        return workers
+    return os.cpu_count() or 1
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+_worker_converters = {}
+_worker_progress = None
+
+def init_conversion_worker(progress):
+    """Initializer процесса пула: общие счётчики прогресса и флаг отмены"""
+    global _worker_progress
+    _worker_progress = progress
+
+def get_worker_converter(options):
+    """Конвертер процесса пула; создаётся один раз на набор параметров"""
+    key = tuple(sorted(options.items()))
+    converter = _worker_converters.get(key)
+    if converter is None:
+        converter = _worker_converters[key] = MessageConverter(**options)
+        if converter.profile_sample:
+            # процесс пула не вызывает close(): профиль сохраняется при его завершении
+            from multiprocessing.util import Finalize
+            Finalize(converter, converter.dump_profile, exitpriority=0)
+    converter.progress = _worker_progress
+    return converter
+
+def convert_file(options, file_path):
+    """Конвертация одного файла в процессе пула; возвращает (результат, счётчики)"""
+    converter = get_worker_converter(options)
+    try:
+        return converter.convert_file(file_path), converter.take_stats()
+    except Exception:
+        converter.take_stats()
+        raise
+
+def should_shard_mbox(file_path):
+    return file_path.lower().endswith(".mbox") and _file_size(file_path) >= MBOX_SHARD_MIN_SIZE
+
+def plan_mbox_shards(mbox_path, shards):
+    """Разбиение MBOX на непрерывные диапазоны писем примерно равного объёма.
+
+    Возвращает [(номер первого письма, [(начало, конец), ...]), ...]; границы
+    берутся из того же разбора, что и при последовательной конвертации,
+    поэтому номера писем (и имена файлов) совпадают.
+    """
+    st = os.stat(mbox_path)
+    index = read_mbox_index(mbox_path)
+    if index and index["size"] == st.st_size and index["mtime"] == st.st_mtime:
+        spans = [(entry[0], entry[0] + entry[1]) for entry in index["entries"]]
+    else:
+        with map_mbox(mbox_path) as mm:
+            spans = list(split_mbox_spans(mm))
+
+    target = max(1, st.st_size // max(1, shards))
+    plan = []
+    current = []
+    current_size = 0
+    first_number = 1
+    for number, (start, end) in enumerate(spans, 1):
+        if not current:
+            first_number = number
+        current.append((start, end))
+        current_size += end - start
+        if current_size >= target:
+            plan.append((first_number, current))
+            current = []
+            current_size = 0
+    if current:
+        plan.append((first_number, current))
+    return plan
+
+def convert_mbox_shard(options, mbox_path, first_number, spans, digest=None):
+    """Конвертация диапазона писем MBOX в процессе пула"""
+    converter = get_worker_converter(options)
+    with map_mbox(mbox_path) as mm:
+        result = converter.convert_mbox_spans(mm, first_number, spans, digest, mbox_path)
+    return result, converter.take_stats()
+
+def iter_conversion_results(files, converter, workers=1, progress=None):
+    """Конвертация набора файлов; отдаёт (путь, результат, ошибка) по мере готовности.
+
+    При нескольких процессах файлы раздаются пулу начиная с самых больших,
+    чтобы длинные задачи не оказались в конце очереди. Большие MBOX делятся
+    на диапазоны писем, которые обрабатываются параллельно.
+
+    progress (ConversionProgress) получает число писем и байтов по мере
+    обработки; после его отмены новые файлы не начинаются, а начатые
+    останавливаются на границе письма и не отмечаются в журнале готовыми.
+    """
+    converter.close()
+    converter.stats.clear()
+    converter.progress = progress
+    try:
+        yield from _iter_conversion_results(files, converter, workers, progress)
+    finally:
+        converter.close()
+        converter.progress = None
+
+def _iter_conversion_results(files, converter, workers, progress):
+    workers = resolve_workers(workers)
+    if workers > 1 and not converter.parallel_safe:
+        logger.info(f"Приёмник '{converter.sink_kind}' пишет в один файл: конвертация в одном процессе")
+        workers = 1
+    if workers <= 1 or (len(files) == 1 and not should_shard_mbox(files[0])):
+        for file_path in files:
+            if converter.cancelled:
+                return
+            try:
+                yield file_path, converter.convert_file(file_path), None
+            except Exception as e:
+                yield file_path, None, e
+        return
+
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    ordered = sorted(files, key=_file_size, reverse=True)
+    options = converter.worker_options()
+    journal = converter.journal
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_conversion_worker,
+                             initargs=(progress,)) as pool:
+        futures = {}
+        shard_results = {}
+        shard_errors = {}
+        failed_messages = set()
+        shard_digests = {}
+        for path in ordered:
+            if should_shard_mbox(path):
+                try:
+                    digest = journal.source_digest(path) if journal else None
+                    if journal and journal.is_source_done(digest):
+                        converted = journal.source_output(digest)
+                        converter.report_progress(len(converted), _file_size(path))
+                        yield path, converted, None
+                        continue
+                    plan = plan_mbox_shards(path, workers * MBOX_SHARDS_PER_WORKER)
+                except Exception as e:
+                    yield path, None, e
+                    continue
+                shard_digests[path] = digest
+                shard_results[path] = [None] * len(plan)
+                for n, (first, spans) in enumerate(plan):
+                    future = pool.submit(convert_mbox_shard, options, path, first, spans, digest)
+                    futures[future] = (path, n)
+                if not plan:
+                    yield path, [], None
+            else:
+                futures[pool.submit(convert_file, options, path)] = (path, None)
+
+        pending = {path: len(parts) for path, parts in shard_results.items()}
+        waiting = set(futures)
+        while waiting:
+            # процессы пула сами не сообщают о ходе работы: общие счётчики
+            # опрашиваются здесь между завершениями задач
+            done, waiting = wait(waiting, timeout=progress.interval if progress else None,
+                                 return_when=FIRST_COMPLETED)
+            if progress is not None:
+                progress.report()
+                if progress.cancelled:
+                    for future in waiting:
+                        future.cancel()
+            for future in done:
+                file_path, n = futures[future]
+                if future.cancelled():
+                    result, error = [], None
+                else:
+                    try:
+                        (result, stats), error = future.result(), None
+                        converter.stats.merge(stats)
+                        if stats["message_errors"]:
+                            failed_messages.add(file_path)
+                    except Exception as e:
+                        result, error = None, e
+                if n is None:
+                    if not future.cancelled():
+                        yield file_path, result, error
+                    continue
+                if error is not None:
+                    shard_errors.setdefault(file_path, error)
+                shard_results[file_path][n] = result or []
+                pending[file_path] -= 1
+                if pending[file_path] == 0:
+                    merged = [path for part in shard_results[file_path] for path in part]
+                    if file_path not in shard_errors and not converter.cancelled:
+                        if journal and file_path not in failed_messages:
+                            journal.record_source(shard_digests[file_path], file_path)
+                        converter.finish_search_source(file_path)
+                    yield file_path, merged if file_path not in shard_errors else None, shard_errors.get(file_path)
+
+def attachment_extension(filename):
+    """Расширение исходного имени вложения, если оно безопасно для имени файла"""
+    extension = os.path.splitext(filename or "")[1].lower()
+    return extension if re.fullmatch(r'\.[\w-]{1,15}', extension) else ""
+
+class AttachmentStore:
+    """Хранилище вложений по содержимому: путь файла — sha256 данных.
+
+    Одинаковые вложения из разных писем записываются один раз. Данные пишутся
+    во временный файл и атомарно переименовываются, поэтому хранилище можно
+    заполнять из нескольких процессов одновременно.
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+
+    def put(self, filename, data):
+        """Сохранить вложение; возвращает (sha256, размер, путь в хранилище, записан_ли файл).
+
+        data — bytes, файл или итератор блоков: содержимое хешируется и копируется
+        блоками HASH_CHUNK_SIZE и целиком в памяти не собирается.
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            # для данных в памяти дубликат виден до записи
+            sha = hashlib.sha256(data).hexdigest()
+            rel_path = os.path.join(sha[:2], sha + attachment_extension(filename))
+            if os.path.exists(os.path.join(self.output_dir, rel_path)):
+                return sha, len(data), rel_path, False
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=self.output_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter_source_chunks(data, HASH_CHUNK_SIZE):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            sha = digest.hexdigest()
+            rel_path = os.path.join(sha[:2], sha + attachment_extension(filename))
+            path = os.path.join(self.output_dir, rel_path)
+            if os.path.exists(path):
+                os.remove(tmp_path)
+                return sha, size, rel_path, False
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+        return sha, size, rel_path, True
+
+def _multipart_spans(buf, start, end, boundary):
+    """Границы частей multipart между строками-разделителями --boundary"""
+    delimiter = b'--' + boundary
+    spans = []
+    part_start = None
+    pos = start
+    while True:
+        idx = buf.find(delimiter, pos, end)
+        if idx == -1:
+            break
+        pos = idx + len(delimiter)
+        if idx > start and buf[idx - 1:idx] != b'\n':
+            continue
+        closing = buf[pos:pos + 2] == b'--'
+        line_end = buf.find(b'\n', pos, end)
+        line_end = end if line_end == -1 else line_end
+        if not closing and buf[pos:line_end].strip():
+            continue
+        if part_start is not None:
+            part_end = max(part_start, idx - 1)
+            if buf[part_end - 1:part_end] == b'\r':
+                part_end -= 1
+            spans.append((part_start, max(part_start, part_end)))
+        if closing:
+            return spans
+        part_start = line_end + 1
+    # без закрывающего разделителя последняя часть идёт до конца письма
+    if part_start is not None and part_start < end:
+        spans.append((part_start, end))
+    return spans
+
+def iter_mime_leaves(buf, start=0, end=None, depth=0):
+    """Листовые части MIME без построения дерева Message: (заголовки, начало тела, конец тела).
+
+    Разбираются только заголовки частей, границы multipart ищутся в байтах;
+    вложенные message/rfc822 раскрываются, как в Message.walk().
+    """
+    end = len(buf) if end is None else end
+    if buf[start:start + 1] in (b'\n', b'\r'):
+        header_end = start
+    else:
+        header_end = _header_end(buf, start, end)
+    headers = HEADER_PARSER.parsebytes(buf[start:header_end])
+    body_start = header_end + (2 if buf[header_end:header_end + 2] == b'\r\n' else
+                               1 if buf[header_end:header_end + 1] == b'\n' else 0)
+    if depth < MIME_MAX_DEPTH:
+        boundary = headers.get_boundary() if headers.get_content_maintype() == "multipart" else None
+        if boundary:
+            for part_start, part_end in _multipart_spans(buf, body_start, end,
+                                                         boundary.encode('ascii', 'surrogateescape')):
+                yield from iter_mime_leaves(buf, part_start, part_end, depth + 1)
+            return
+        encoding = str(headers.get("Content-Transfer-Encoding", "")).strip().lower()
+        if headers.get_content_type() == "message/rfc822" and encoding not in ("base64", "quoted-printable"):
+            yield from iter_mime_leaves(buf, body_start, end, depth + 1)
+            return
+    yield headers, body_start, end
+
+def decode_mime_payload(buf, headers, start, end):
+    """Содержимое листовой части с учётом Content-Transfer-Encoding (как get_payload(decode=True))"""
+    headers.set_payload(bytes(buf[start:end]).decode('ascii', 'surrogateescape'))
+    return headers.get_payload(decode=True)
+
+def _base64_windows(buf, start, end):
+    """buf[start:end] без пробельных символов кусками по целым строкам около HASH_CHUNK_SIZE"""
+    pos = start
+    while pos < end:
+        stop = min(end, pos + HASH_CHUNK_SIZE)
+        if stop < end:
+            line_end = buf.find(b'\n', stop, end)
+            stop = end if line_end == -1 else line_end + 1
+        yield bytes(buf[pos:stop]).translate(None, BASE64_SPACE)
+        pos = stop
+
+def _decode_base64_windows(buf, start, end):
+    tail = b''
+    for window in _base64_windows(buf, start, end):
+        data = tail + window
+        cut = len(data) - len(data) % 4
+        tail = data[cut:]
+        if cut:
+            yield binascii.a2b_base64(data[:cut])
+    if tail:
+        yield binascii.a2b_base64(tail + b'=' * (-len(tail) % 4))
+
+def iter_base64_payload(buf, start, end):
+    """Итератор блоков декодированной base64-части или None, если это не чистый base64.
+
+    Части с посторонними символами или неверным дополнением возвращаются
+    decode_mime_payload, который разбирает их так же терпимо, как email.
+    """
+    total = 0
+    padded = False
+    for window in _base64_windows(buf, start, end):
+        if not window:
+            continue
+        if padded or window.translate(None, BASE64_ALPHABET):
+            return None
+        pad = window.find(b'=')
+        if pad != -1:
+            if window[pad:].strip(b'=') or len(window) - pad > 2:
+                return None
+            padded = True
+        total += len(window)
+    if not total or total % 4 == 1 or (padded and total % 4):
+        return None
+    return _decode_base64_windows(buf, start, end)
+
+def iter_mime_attachments(buf, start=0, end=None, source=None):
+    """Вложения письма по его сырым байтам: (имя, MIME-тип, данные).
+
+    Данные base64-частей — итератор блоков, декодируемых по мере чтения;
+    остальные части декодируются целиком.
+    """
+    for headers, body_start, body_end in iter_mime_leaves(buf, start, end):
+        filename = headers.get_filename()
+        if not filename and "attachment" not in str(headers.get("Content-Disposition", "")).lower():
+            continue
+        data = None
+        if str(headers.get("Content-Transfer-Encoding", "")).lower() == "base64":
+            data = iter_base64_payload(buf, body_start, body_end)
+        if data is None:
+            data = decode_mime_payload(buf, headers, body_start, body_end)
+        if data:
+            yield decode_header_safe(filename, source) or "attachment.bin", headers.get_content_type(), data
+
+def attachment_cid(att):
+    cid = getattr(att, 'cid', None) or getattr(att, 'contentId', None)
+    return cid.strip('<> ') if cid else None
+
+def attachment_cid_map(attachments):
+    """Content-ID (без <>) -> вложение; строится один раз на письмо, при повторах берётся первое"""
+    mapping = {}
+    for att in attachments:
+        cid = attachment_cid(att)
+        if cid:
+            mapping.setdefault(cid, att)
+    return mapping
+
+class AttachmentHandle:
+    """Вложение в списке предпросмотра: имя, размер и MIME-тип без чтения содержимого.
+
+    Данные получает loader() при вызове read(); handle их не хранит.
+    """
+
+    def __init__(self, name, size, mime_type, loader, cid=None):
+        self.name = name
+        self.size = size
+        self.mime_type = mime_type
+        self.cid = cid
+        self._loader = loader
+
+    def read(self):
+        return self._loader()
+
+def mime_payload_size(buf, headers, start, end):
+    """Примерный размер декодированной части по её закодированным байтам"""
+    size = end - start
+    if str(headers.get("Content-Transfer-Encoding", "")).strip().lower() == "base64":
+        size -= buf.count(b'\n', start, end) + buf.count(b'\r', start, end)
+        size = size * 3 // 4
+    return size
+
+def mbox_preview_parts(mbox_path, offset, length):
+    """Письмо MBOX для предпросмотра: (заголовки, текст, HTML, [AttachmentHandle, ...]).
+
+    Декодируются только текстовые части; вложение при read() заново читает
+    письмо из файла и декодирует лишь свою часть. В сжатом ящике чтение по
+    смещению распаковывает поток с начала, поэтому вложения берутся из уже
+    прочитанной копии письма — одной на весь предпросмотр.
+    """
+    data = load_mbox_entry_bytes(mbox_path, offset, length)
+    shared = data if is_compressed_mbox(mbox_path) else None
+    headers = read_mbox_headers(data, 0, len(data))
+    text, html = "", ""
+    attachments = []
+    for part, start, end in iter_mime_leaves(data):
+        content_type = part.get_content_type()
+        filename = part.get_filename()
+        is_attachment = "attachment" in str(part.get("Content-Disposition", "")).lower()
+        if content_type in ("text/plain", "text/html") and not is_attachment:
+            payload = decode_mime_payload(data, part, start, end)
+            decoded = decode_bytes(payload, part.get_content_charset(), mbox_path)[0] if payload else ""
+            if content_type == "text/html":
+                html = decoded
+            else:
+                text = decoded
+        elif is_attachment or filename:
+            def loader(part=part, start=start, end=end):
+                source = shared if shared is not None else load_mbox_entry_bytes(mbox_path, offset, length)
+                return decode_mime_payload(source, part, start, end)
+            attachments.append(AttachmentHandle(
+                decode_header_safe(filename, mbox_path) or "attachment.bin",
+                mime_payload_size(data, part, start, end), content_type, loader,
+                str(part.get("Content-ID", "")).strip("<> ") or None))
+    return headers, text, html, attachments
+
+def iter_mbox_content_parts(data, source=None):
+    """Текст, HTML и данные вложений письма MBOX — те же части, что берутся у MSG для ключа дедупликации.
+
+    Генератор: письмо разбирается, только если message_dedup_key дошёл до содержимого.
+    """
+    text, html = "", ""
+    attachments = []
+    for part, start, end in iter_mime_leaves(data):
+        content_type = part.get_content_type()
+        is_attachment = "attachment" in str(part.get("Content-Disposition", "")).lower()
+        if content_type in ("text/plain", "text/html") and not is_attachment:
+            payload = decode_mime_payload(data, part, start, end)
+            decoded = decode_bytes(payload, part.get_content_charset(), source)[0] if payload else ""
+            if content_type == "text/html":
+                html = decoded
+            else:
+                text = decoded
+        elif is_attachment or part.get_filename():
+            payload = decode_mime_payload(data, part, start, end)
+            if payload:
+                attachments.append(payload)
+    yield text
+    yield html
+    yield from attachments
+
+def _ole_string(ole, storage, prop):
+    for suffix in ("001F", "001E"):
+        stream = [storage, f"__substg1.0_{prop}{suffix}"] if storage else [f"__substg1.0_{prop}{suffix}"]
+        if ole.exists("/".join(stream)):
+            data = ole.openstream(stream).read()
+            if suffix == "001F":
+                return data.decode("utf-16-le", errors="replace").rstrip("\x00")
+            return decode_bytes(data.rstrip(b"\x00"))[0]
+    return None
+
+@contextlib.contextmanager
+def open_msg(msg_path, **kwargs):
+    """MSG-файл на время блока with; OLE-файл закрывается при выходе, а не сборщиком мусора"""
+    import extract_msg
+    msg = extract_msg.Message(msg_path, **kwargs)
+    try:
+        yield msg
+    finally:
+        close = getattr(msg, 'close', None)
+        if close:
+            close()
+
+class SpooledAttachment:
+    """Вложение MSG, прочитанное отдельно от письма; атрибуты как у extract_msg.Attachment.
+
+    data — bytes или временный файл, если вложение не уместилось в лимит памяти письма.
+    """
+
+    def __init__(self, long_name, short_name, mime_type, cid, data=None):
+        self.longFilename = long_name
+        self.shortFilename = short_name
+        self.mimetype = mime_type
+        self.cid = cid
+        self.data = data
+
+def msg_attachment_streams(ole):
+    """(хранилище, поток данных) вложений открытого OLE-файла MSG; вложенные письма пропускаются"""
+    storages = sorted({entry[0] for entry in ole.listdir(streams=True, storages=True)
+                       if entry[0].startswith(MSG_ATTACH_PREFIX)})
+    for storage in storages:
+        stream = [storage, "__substg1.0_37010102"]
+        if ole.exists("/".join(stream)):
+            yield storage, stream
+
+def iter_ole_stream_chunks(ole, stream):
+    """Блоки потока OLE до HASH_CHUNK_SIZE.
+
+    olefile.openstream держит поток в памяти целиком; блоками он отдаётся,
+    чтобы запись и хэширование не делали ещё одну копию.
+    """
+    with ole.openstream(stream) as f:
+        yield from iter(lambda: f.read(HASH_CHUNK_SIZE), b'')
+
+def copy_ole_stream(ole, stream, out):
+    """Копирует поток OLE в файл out блоками до HASH_CHUNK_SIZE"""
+    for chunk in iter_ole_stream_chunks(ole, stream):
+        out.write(chunk)
+
+def _read_ole_stream(msg_path, stream):
+    import olefile
+    with olefile.OleFileIO(msg_path) as ole:
+        return ole.openstream(stream).read()
+
+def msg_attachment_handles(msg_path, msg=None):
+    """Вложения MSG без чтения содержимого: имя, размер и тип берутся из каталога OLE.
+
+    Вложенные письма и OLE-объекты (без потока данных) пропускаются. Если файл
+    не читается как OLE, handles строятся из msg.attachments.
+    """
+    try:
+        import olefile
+        with olefile.OleFileIO(msg_path) as ole:
+            handles = []
+            for storage, stream in msg_attachment_streams(ole):
+                name = _ole_string(ole, storage, "3707") or _ole_string(ole, storage, "3704") or "attachment.bin"
+                mime_type = (_ole_string(ole, storage, "370E") or mimetypes.guess_type(name)[0]
+                             or "application/octet-stream")
+                handles.append(AttachmentHandle(
+                    name, ole.get_size("/".join(stream)), mime_type,
+                    lambda stream=stream: _read_ole_stream(msg_path, stream),
+                    (_ole_string(ole, storage, "3712") or "").strip("<> ") or None))
+            return handles
+    except (ImportError, OSError) as e:
+        if msg is None:
+            raise
+        logger.info(f"Вложения {msg_path} читаются через объект письма: {str(e)}")
+    handles = []
+    for att in getattr(msg, 'attachments', []):
+        fields = msg_attachment_fields(att)
+        if fields:
+            name, mime_type, data = fields
+            cid = getattr(att, 'cid', None) or getattr(att, 'contentId', None)
+            handles.append(AttachmentHandle(name, len(data), mime_type, lambda data=data: bytes(data),
+                                            cid.strip("<> ") if cid else None))
+    return handles
+
+def msg_attachment_fields(att):
+    """(имя, MIME-тип, данные) вложения MSG или None для вложенных писем и пустых вложений"""
+    filename = getattr(att, 'longFilename', None) or getattr(att, 'shortFilename', None) or "attachment.bin"
+    data = getattr(att, 'data', None)
+    if isinstance(data, str):
+        data = data.encode(errors="replace")
+    if not isinstance(data, (bytes, bytearray, memoryview)) or not data:
+        return None
+    mime_type = getattr(att, 'mimetype', None) or mimetypes.guess_type(filename)[0]
+    return filename, mime_type or "application/octet-stream", data
+
+def iter_msg_attachments(msg):
+    """Вложения MSG-объекта: (имя, MIME-тип, данные); вложенные письма пропускаются"""
+    for att in getattr(msg, 'attachments', []):
+        fields = msg_attachment_fields(att)
+        if fields:
+            yield fields
+
+def _store_attachments(store, attachments, message):
+    records = []
+    for filename, content_type, data in attachments:
+        sha, size, rel_path, written = store.put(filename, data)
+        records.append(dict(message, filename=filename, content_type=content_type,
+                            size=size, sha256=sha, path=rel_path, written=written))
+    return records
+
+def extract_mbox_attachments(output_dir, mbox_path, first_number=1, spans=None):
+    """Вложения писем MBOX (или диапазона spans) в хранилище; возвращает записи манифеста.
+
+    Письма без multipart и без имени файла в заголовках пропускаются по одним заголовкам.
+    """
+    store = AttachmentStore(output_dir)
+    records = []
+    if spans is None:
+        blocks = iter_mbox_blocks(mbox_path)
+    else:
+        blocks = _mapped_spans(mbox_path, spans)
+    i = first_number - 1
+    for buf, base, block_spans in blocks:
+        for start, end in block_spans:
+            i += 1
+            try:
+                headers = read_mbox_headers(buf, start, end)
+                if headers.get_content_maintype() != "multipart" and not headers.get_filename():
+                    continue
+                message = {
+                    "source": mbox_path,
+                    "message": i,
+                    "offset": base + start,
+                    "subject": decode_header_safe(headers.get("Subject", ""), mbox_path),
+                    "message_id": str(headers.get("Message-ID", "")).strip(),
+                }
+                attachments = iter_mime_attachments(mbox_entry_bytes(buf[start:end]), source=mbox_path)
+                records.extend(_store_attachments(store, attachments, message))
+            except Exception as e:
+                logger.error(f"Ошибка извлечения вложений письма {i} из {mbox_path}: {str(e)}")
+    return records
+
+def _mapped_spans(mbox_path, spans):
+    with map_mbox(mbox_path) as mm:
+        yield mm, 0, spans
+
+def iter_ole_attachments(ole):
+    """Вложения открытого OLE-файла MSG: (имя, MIME-тип, итератор блоков); пустые пропускаются"""
+    for storage, stream in msg_attachment_streams(ole):
+        if not ole.get_size("/".join(stream)):
+            continue
+        name = _ole_string(ole, storage, "3707") or _ole_string(ole, storage, "3704") or "attachment.bin"
+        mime_type = _ole_string(ole, storage, "370E") or mimetypes.guess_type(name)[0]
+        yield name, mime_type or "application/octet-stream", iter_ole_stream_chunks(ole, stream)
+
+def extract_msg_attachments(output_dir, msg_path):
+    """Вложения MSG в хранилище; содержимое копируется из OLE блоками, не читаясь в память.
+
+    extract_msg загружает все вложения при открытии письма, поэтому он
+    используется, только если файл не читается через olefile.
+    """
+    try:
+        import olefile
+        ole = olefile.OleFileIO(msg_path)
+    except (ImportError, OSError) as e:
+        logger.info(f"Вложения {msg_path} читаются через объект письма: {str(e)}")
+        with open_msg(msg_path) as msg:
+            message = {
+                "source": msg_path,
+                "message": None,
+                "offset": None,
+                "subject": getattr(msg, 'subject', None) or "",
+                "message_id": str(getattr(msg, 'messageId', None) or "").strip(),
+            }
+            return _store_attachments(AttachmentStore(output_dir), iter_msg_attachments(msg), message)
+    with ole:
+        message = {
+            "source": msg_path,
+            "message": None,
+            "offset": None,
+            "subject": _ole_string(ole, None, "0037") or "",
+            "message_id": (_ole_string(ole, None, "1035") or "").strip(),
+        }
+        return _store_attachments(AttachmentStore(output_dir), iter_ole_attachments(ole), message)
+
+def extract_file_attachments(output_dir, file_path):
+    """Вложения одного файла MSG или MBOX в хранилище; возвращает записи манифеста"""
+    if is_mbox_path(file_path):
+        return extract_mbox_attachments(output_dir, file_path)
+    return extract_msg_attachments(output_dir, file_path)
+
+def iter_attachment_extraction(files, output_dir, workers=1):
+    """Извлечение вложений набора файлов; отдаёт (путь, записи, ошибка) по мере готовности.
+
+    Файлы и диапазоны писем больших MBOX раздаются пулу процессов, поэтому
+    для одного MBOX результат может прийти несколькими частями.
+    """
+    workers = resolve_workers(workers)
+    if workers <= 1 or (len(files) == 1 and not should_shard_mbox(files[0])):
+        for file_path in files:
+            try:
+                yield file_path, extract_file_attachments(output_dir, file_path), None
+            except Exception as e:
+                yield file_path, None, e
+        return
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for path in sorted(files, key=_file_size, reverse=True):
+            if not should_shard_mbox(path):
+                futures[pool.submit(extract_file_attachments, output_dir, path)] = path
+                continue
+            try:
+                plan = plan_mbox_shards(path, workers * MBOX_SHARDS_PER_WORKER)
+            except Exception as e:
+                yield path, None, e
+                continue
+            for first, spans in plan:
+                futures[pool.submit(extract_mbox_attachments, output_dir, path, first, spans)] = path
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
+
+def extract_attachments(files, output_dir, workers=1, progress=None):
+    """Извлечь вложения файлов в хранилище output_dir и дописать манифест.
+
+    Манифест ATTACHMENT_MANIFEST — строки JSON «письмо → вложение → файл
+    хранилища». progress(путь) вызывается после каждого готового файла или
+    диапазона писем. Возвращает сводку запуска.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    started = time.time()
+    summary = {"files": len(files), "attachments": 0, "stored": 0, "bytes": 0, "stored_bytes": 0, "errors": []}
+    manifest_path = os.path.join(output_dir, ATTACHMENT_MANIFEST)
+    with open(manifest_path, 'a', encoding='utf-8') as manifest:
+        for file_path, records, error in iter_attachment_extraction(files, output_dir, workers):
+            if error is not None:
+                logger.error(f"Ошибка извлечения вложений из {file_path}: {str(error)}")
+                summary["errors"].append({"file": file_path, "error": str(error)})
+            for record in records or []:
+                written = record.pop("written")
+                summary["attachments"] += 1
+                summary["bytes"] += record["size"]
+                if written:
+                    summary["stored"] += 1
+                    summary["stored_bytes"] += record["size"]
+                manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
+            manifest.flush()
+            if progress:
+                progress(file_path)
+    summary["elapsed"] = round(time.time() - started, 3)
+    summary["manifest"] = manifest_path
+    return summary
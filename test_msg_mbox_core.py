@@ -0,0 +1,842 @@
+"""Регрессионные тесты конвертера на сгенерированных MSG и MBOX.
+
+Запуск: python -m unittest test_msg_mbox_core (или pytest).
+"""
+import os
+import contextlib
+import gzip
+import hashlib
+import io
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import zipfile
+import mailbox
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+from email.message import EmailMessage
+from email.parser import BytesHeaderParser
+from functools import partial
+from unittest import mock
+
+import msg_mbox_core
+from msg_mbox_bench import build_msg_file
+from msg_mbox_core import MessageConverter, ErrorReport, iter_conversion_results
+
+
+def message_spec(attachment_size=300 * 1024):
+    rng = random.Random(1)
+    return {
+        "subject": "Отчёт за квартал",
+        "body": "Текст письма\nвторая строка\n",
+        "html": '<html><body><p>Текст</p><img src="cid:img1@test"></body></html>',
+        "sender": "Иван Петров <ivan@example.ru>",
+        "to": "Мария <maria@example.ru>",
+        "message_id": "<1@test>",
+        "date": datetime(2021, 3, 4, 5, 6),
+        "inline": [("image0.png", b"\x89PNG\r\n\x1a\n" + rng.randbytes(100 * 1024), "img1@test")],
+        "attachments": [("отчёт.pdf", rng.randbytes(attachment_size), "application/pdf"),
+                        ("заметка.txt", b"short", "text/plain"),
+                        # MIME-тип картинки без картиночного имени: по-прежнему обычное вложение
+                        ("scan.dat", rng.randbytes(2048), "image/jpeg")],
+    }
+
+
+class MsgMemoryCapTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="msg_mbox_test_")
+        self.msg_path = os.path.join(self.workdir, "letter.msg")
+        build_msg_file(message_spec(), self.msg_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def convert(self, memory_cap):
+        converter = MessageConverter(os.path.join(self.workdir, f"out_{memory_cap}"), memory_cap=memory_cap)
+        # границы MIME случайны; одинаковое зерно даёт одинаковые границы
+        random.seed(0)
+        try:
+            path = converter.convert_msg_to_eml(self.msg_path)
+        finally:
+            converter.close()
+        with open(path, "rb") as f:
+            return f.read(), converter.stats
+
+    def test_same_output_with_and_without_cap(self):
+        plain, _stats = self.convert(0)
+        capped, stats = self.convert(64 * 1024)
+        self.assertEqual(stats["spooled_attachments"], 2)
+        self.assertEqual(plain, capped)
+
+    def test_cap_larger_than_message_keeps_everything_in_memory(self):
+        plain, _stats = self.convert(0)
+        capped, stats = self.convert(msg_mbox_core.MSG_MEMORY_CAP)
+        self.assertEqual(stats["spooled_attachments"], 0)
+        self.assertEqual(plain, capped)
+
+
+class MsgAttachmentStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="msg_mbox_test_")
+        self.msg_path = os.path.join(self.workdir, "letter.msg")
+        build_msg_file(message_spec(), self.msg_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_stream_chunks_match_stream(self):
+        import olefile
+        with olefile.OleFileIO(self.msg_path) as ole:
+            streams = list(msg_mbox_core.msg_attachment_streams(ole))
+            self.assertTrue(streams)
+            for _storage, stream in streams:
+                chunks = list(msg_mbox_core.iter_ole_stream_chunks(ole, stream))
+                self.assertTrue(all(len(chunk) <= msg_mbox_core.HASH_CHUNK_SIZE for chunk in chunks))
+                self.assertEqual(b"".join(chunks), ole.openstream(stream).read())
+
+    def test_spooled_image_is_inline(self):
+        converter = MessageConverter(os.path.join(self.workdir, "out"))
+        image = msg_mbox_core.SpooledAttachment("scan", "scan", "image/png", None, b"png")
+        document = msg_mbox_core.SpooledAttachment("scan", "scan", "application/pdf", None, b"pdf")
+        self.assertTrue(converter.is_inline_attachment(image))
+        self.assertFalse(converter.is_inline_attachment(document))
+
+
+def mbox_message(number, subject):
+    body = "".join(f"Строка {k} письма {number}\n" for k in range(20))
+    return (f"From sender@example.ru Mon Jan  4 10:00:{number % 60:02d} 2021\n"
+            f"From: sender@example.ru\nSubject: {subject}\nMessage-ID: <{number}@test>\n"
+            f"Content-Type: text/plain; charset=utf-8\n\n{body}\n").encode("utf-8")
+
+
+class MboxSplitTest(unittest.TestCase):
+    """Границы писем MBOX: mboxo, mboxrd, Content-Length и разделители без пустой строки"""
+
+    def split(self, data):
+        entries = [msg_mbox_core.mbox_entry_bytes(data[start:end])
+                   for start, end in msg_mbox_core.split_mbox_spans(data)]
+        # потоковое чтение маленькими блоками даёт те же границы
+        streamed = [msg_mbox_core.mbox_entry_bytes(buf[start:end])
+                    for buf, _base, spans in msg_mbox_core.iter_mbox_stream_blocks(io.BytesIO(data), chunk_size=37)
+                    for start, end in spans]
+        self.assertEqual(streamed, entries)
+        return entries
+
+    def stdlib_count(self, data):
+        path = os.path.join(self.workdir, "stdlib.mbox")
+        with open(path, "wb") as f:
+            f.write(data)
+        box = mailbox.mbox(path)
+        try:
+            return len(box)
+        finally:
+            box.close()
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="msg_mbox_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_separator_without_blank_line(self):
+        data = (b"From a@example.ru Mon Jan  4 10:00:00 2021\nSubject: 1\n\nbody 1\n"
+                b"From b@example.ru Tue Jan  5 11:30:00 2021\nSubject: 2\n\nbody 2\n"
+                b"From - Wed Jan  6 12:00:00 +0300 2021\nSubject: 3\n\nbody 3\n")
+        entries = self.split(data)
+        self.assertEqual(len(entries), self.stdlib_count(data))
+        self.assertEqual(entries, [b"Subject: 1\n\nbody 1\n", b"Subject: 2\n\nbody 2\n",
+                                   b"Subject: 3\n\nbody 3\n"])
+
+    def test_crlf_separator_without_blank_line(self):
+        data = (b"From a@example.ru Mon Jan  4 10:00:00 2021\r\nSubject: 1\r\n\r\nbody 1\r\n"
+                b"From b@example.ru Tue Jan  5 11:30:00 2021\r\nSubject: 2\r\n\r\nbody 2\r\n")
+        self.assertEqual(len(self.split(data)), 2)
+
+    def test_mboxo_body_line_is_not_a_separator(self):
+        data = (b"From a@example.ru Mon Jan  4 10:00:00 2021\nSubject: 1\n\nline\nFrom the team,\nIvan\n\n"
+                b"From b@example.ru Tue Jan  5 11:30:00 2021\nSubject: 2\n\nbody 2\n")
+        entries = self.split(data)
+        self.assertEqual(len(entries), 2)
+        self.assertIn(b"\nFrom the team,\n", entries[0])
+
+    def test_mboxrd_unescapes_from_lines(self):
+        data = (b"From a@example.ru Mon Jan  4 10:00:00 2021\nSubject: 1\n\n"
+                b">From here\n>>From there\n\n>From a@example.ru Mon Jan  4 10:00:00 2021\n\n"
+                b"From b@example.ru Tue Jan  5 11:30:00 2021\nSubject: 2\n\nbody 2\n")
+        entries = self.split(data)
+        self.assertEqual(len(entries), self.stdlib_count(data))
+        self.assertEqual(entries[0], b"Subject: 1\n\nFrom here\n>From there\n\n"
+                                     b"From a@example.ru Mon Jan  4 10:00:00 2021\n\n")
+
+    def test_content_length_covers_from_lines(self):
+        body = b"start\n\nFrom x@example.ru Mon Jan  4 10:00:00 2021\nnot a message\n"
+        data = (b"From a@example.ru Mon Jan  4 10:00:00 2021\nSubject: 1\nContent-Length: %d\n\n" % len(body)
+                + body + b"\nFrom b@example.ru Tue Jan  5 11:30:00 2021\nSubject: 2\n\nbody 2\n")
+        entries = self.split(data)
+        self.assertEqual(len(entries), 2)
+        self.assertTrue(entries[0].endswith(body + b"\n"))
+        self.assertEqual(entries[1], b"Subject: 2\n\nbody 2\n")
+
+
+class CompressedMboxErrorTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="msg_mbox_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_quarantine_copy_of_streamed_message(self):
+        messages = [mbox_message(i, "BROKEN" if i == 25 else f"Письмо {i}") for i in range(1, 31)]
+        mbox_path = os.path.join(self.workdir, "mail.mbox.gz")
+        with gzip.open(mbox_path, "wb") as f:
+            f.write(b"".join(messages))
+
+        original = msg_mbox_core.sanitize_filename
+
+        def failing(name):
+            if "BROKEN" in name:
+                raise ValueError("сбой письма")
+            return original(name)
+
+        output_dir = os.path.join(self.workdir, "out")
+        converter = MessageConverter(output_dir)
+        # маленькие блоки распаковки: ошибочное письмо лежит не в первом блоке
+        with mock.patch.object(msg_mbox_core, "iter_mbox_stream_blocks",
+                               partial(msg_mbox_core.iter_mbox_stream_blocks, chunk_size=2048)), \
+                mock.patch.object(msg_mbox_core, "sanitize_filename", failing):
+            converted = converter.convert_mbox_to_eml(mbox_path)
+        converter.close()
+        self.assertEqual(len(converted), 29)
+
+        report = ErrorReport(output_dir, quarantine=True)
+        # письмо берётся из сохранённых при ошибке байтов, MBOX не читается снова
+        with mock.patch.object(msg_mbox_core, "open_mbox", side_effect=AssertionError("повторное чтение MBOX")):
+            try:
+                [entry] = report.add_stats_errors(converter.stats)
+            finally:
+                report.close()
+        self.assertEqual(entry["message"], 25)
+        with open(entry["quarantine"], "rb") as f:
+            self.assertEqual(f.read(), messages[24])
+
+
+class CompressedPreviewTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="msg_mbox_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_attachments_read_from_one_copy(self):
+        rng = random.Random(3)
+        message = EmailMessage()
+        message["Subject"] = "Картинки"
+        message.set_content("Текст")
+        images = [rng.randbytes(20000) for _ in range(4)]
+        for number, data in enumerate(images):
+            message.add_attachment(data, maintype="image", subtype="png", filename=f"{number}.png",
+                                   cid=f"<img{number}@test>")
+        data = b"From sender@example.ru Mon Jan  4 10:00:00 2021\n" + message.as_bytes() + b"\n"
+        plain_path = os.path.join(self.workdir, "mail.mbox")
+        with open(plain_path, "wb") as f:
+            f.write(data)
+        gz_path = plain_path + ".gz"
+        with gzip.open(gz_path, "wb") as f:
+            f.write(data)
+
+        _headers, _text, _html, plain = msg_mbox_core.mbox_preview_parts(plain_path, 0, len(data))
+        with mock.patch.object(msg_mbox_core, "read_mbox_range", wraps=msg_mbox_core.read_mbox_range) as reads:
+            _headers, _text, _html, compressed = msg_mbox_core.mbox_preview_parts(gz_path, 0, len(data))
+            payloads = [handle.read() for handle in compressed]
+        self.assertEqual(reads.call_count, 1)
+        self.assertEqual(payloads, images)
+        self.assertEqual(payloads, [handle.read() for handle in plain])
+
+
+class AttachmentStoreTest(unittest.TestCase):
+    """Вложения копируются в хранилище блоками; содержимое и sha256 совпадают с исходными"""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="msg_mbox_test_")
+        self.output_dir = os.path.join(self.workdir, "attachments")
+        # блок меньше вложений: данные проходят через хранилище несколькими частями
+        patcher = mock.patch.object(msg_mbox_core, "HASH_CHUNK_SIZE", 4096)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def assertStored(self, records, expected):
+        stored = {}
+        for record in records:
+            with open(os.path.join(self.output_dir, record["path"]), "rb") as f:
+                data = f.read()
+            self.assertEqual(hashlib.sha256(data).hexdigest(), record["sha256"])
+            self.assertEqual(len(data), record["size"])
+            stored[record["filename"]] = data
+        self.assertEqual(stored, expected)
+
+    def test_msg_attachments(self):
+        spec = message_spec()
+        msg_path = os.path.join(self.workdir, "letter.msg")
+        build_msg_file(spec, msg_path)
+        records = msg_mbox_core.extract_file_attachments(self.output_dir, msg_path)
+        self.assertEqual(records[0]["subject"], spec["subject"])
+        self.assertStored(records, {name: data for name, data, _extra in spec["inline"] + spec["attachments"]})
+
+    def test_mbox_attachments(self):
+        rng = random.Random(2)
+        expected = {"data.bin": rng.randbytes(50000), "tail.bin": rng.randbytes(4097)}
+        message = EmailMessage()
+        message["Subject"] = "Вложения"
+        message.set_content("Текст")
+        for name, data in expected.items():
+            message.add_attachment(data, maintype="application", subtype="octet-stream", filename=name)
+        mbox_path = os.path.join(self.workdir, "mail.mbox")
+        with open(mbox_path, "wb") as f:
+            f.write(b"From sender@example.ru Mon Jan  4 10:00:00 2021\n" + message.as_bytes() + b"\n")
+        records = msg_mbox_core.extract_file_attachments(self.output_dir, mbox_path)
+        self.assertStored(records, expected)
+        self.assertEqual([name for name in os.listdir(self.output_dir) if name.startswith(".tmp-")], [])
+
+
+CRASH_SCRIPT = """
+import os, sys
+sys.path.insert(0, {repo!r})
+import msg_mbox_core
+original = msg_mbox_core.sanitize_filename
+
+def crash(name):
+    # аварийное завершение без close(), как при kill
+    if name.startswith({crash_at!r}):
+        os._exit(3)
+    return original(name)
+
+msg_mbox_core.sanitize_filename = crash
+converter = msg_mbox_core.MessageConverter({output_dir!r}, resume=True, sink={sink!r})
+converter.convert_mbox_to_eml({mbox_path!r})
+"""
+
+
+def sink_messages(output_dir, sink):
+    """Байты всех писем, которые читаются из результата приёмника"""
+    if sink == "zip":
+        with zipfile.ZipFile(os.path.join(output_dir, "messages.zip")) as archive:
+            return [archive.read(name) for name in archive.namelist()]
+    if sink == "tar":
+        with tarfile.open(os.path.join(output_dir, "messages.tar")) as archive:
+            return [archive.extractfile(member).read() for member in archive.getmembers()]
+    if sink == "mbox":
+        box = mailbox.mbox(os.path.join(output_dir, "messages.mbox"), create=False)
+        try:
+            return [box.get_bytes(key) for key in box.keys()]
+        finally:
+            box.close()
+    folder = os.path.join(output_dir, "Maildir", "new") if sink == "maildir" else output_dir
+    blobs = []
+    for name in os.listdir(folder):
+        if not name.startswith("."):
+            with open(os.path.join(folder, name), "rb") as f:
+                blobs.append(f.read())
+    return blobs
+
+
+def sink_subjects(output_dir, sink):
+    """Темы всех писем, которые читаются из результата приёмника"""
+    parser = BytesHeaderParser()
+    return sorted(str(parser.parsebytes(blob)["Subject"]) for blob in sink_messages(output_dir, sink))
+
+
+class SinkOutputTest(unittest.TestCase):
+    """Каждый приёмник хранит те же письма, что и папка с .eml"""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="msg_mbox_test_")
+        self.files = [os.path.join(self.workdir, "mail.mbox"), os.path.join(self.workdir, "letter.msg")]
+        with open(self.files[0], "wb") as f:
+            f.write(b"".join(mbox_message(i, f"Letter {i}") for i in range(1, 6)))
+        build_msg_file(message_spec(attachment_size=4096), self.files[1])
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def convert(self, sink):
+        output_dir = os.path.join(self.workdir, sink)
+        converter = MessageConverter(output_dir, sink=sink)
+        # границы MIME случайны; одинаковое зерно даёт одинаковые письма
+        random.seed(0)
+        results = list(iter_conversion_results(self.files, converter, 1))
+        self.assertEqual([error for _path, _result, error in results], [None, None])
+        return sorted(sink_messages(output_dir, sink))
+
+    def check_sink(self, sink):
+        expected = self.convert("directory")
+        self.assertEqual(len(expected), 6)
+        self.assertEqual(self.convert(sink), expected)
+
+    def test_zip(self):
+        self.check_sink("zip")
+        with zipfile.ZipFile(os.path.join(self.workdir, "zip", "messages.zip")) as archive:
+            self.assertIsNone(archive.testzip())
+            names = sorted(archive.namelist())
+        self.assertEqual(names, sorted(name for name in os.listdir(os.path.join(self.workdir, "directory"))
+                                       if name.endswith(".eml")))
+
+    def test_tar(self):
+        self.check_sink("tar")
+
+    def test_maildir(self):
+        self.check_sink("maildir")
+        self.assertEqual(len(mailbox.Maildir(os.path.join(self.workdir, "maildir", "Maildir"))), 6)
+
+    def test_mbox(self):
+        self.check_sink("mbox")
+
+
+class SinkCrashResumeTest(unittest.TestCase):
+    """Сеанс, оборванный без close(), не теряет и не удваивает письма после возобновления"""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="msg_mbox_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def write_mbox(self, name, prefix, count):
+        path = os.path.join(self.workdir, name)
+        with open(path, "wb") as f:
+            f.write(b"".join(mbox_message(i, f"{prefix} {i}") for i in range(1, count + 1)))
+        return path
+
+    def check_sink(self, sink):
+        output_dir = os.path.join(self.workdir, sink)
+        first = self.write_mbox(f"first-{sink}.mbox", "First", 50)
+        second = self.write_mbox(f"second-{sink}.mbox", "Second", 200)
+        converter = MessageConverter(output_dir, resume=True, sink=sink)
+        converter.convert_mbox_to_eml(first)
+        converter.close()
+
+        script = CRASH_SCRIPT.format(repo=os.path.dirname(os.path.abspath(msg_mbox_core.__file__)),
+                                     crash_at="150_", output_dir=output_dir, sink=sink, mbox_path=second)
+        self.assertEqual(subprocess.run([sys.executable, "-c", script]).returncode, 3)
+
+        converter = MessageConverter(output_dir, resume=True, sink=sink)
+        try:
+            converted = converter.convert_mbox_to_eml(second)
+        finally:
+            converter.close()
+        self.assertEqual(len(converted), 200)
+        expected = sorted([f"First {i}" for i in range(1, 51)] + [f"Second {i}" for i in range(1, 201)])
+        self.assertEqual(sink_subjects(output_dir, sink), expected)
+
+    def test_directory(self):
+        self.check_sink("directory")
+
+    def test_maildir(self):
+        self.check_sink("maildir")
+
+    def test_zip(self):
+        self.check_sink("zip")
+
+    def test_tar(self):
+        self.check_sink("tar")
+
+    def test_mbox(self):
+        self.check_sink("mbox")
+
+
+class GateSink:
+    """Приёмник для пула записи: open ждёт gate, имена из failing дают ошибку"""
+    thread_safe = True
+
+    def __init__(self, failing=()):
+        self.gate = threading.Event()
+        self.failing = failing
+        self.written = {}
+
+    def location(self, name):
+        return name
+
+    @contextlib.contextmanager
+    def open(self, name):
+        self.gate.wait()
+        if name in self.failing:
+            raise OSError(f"нет места для {name}")
+        f = io.BytesIO()
+        yield f, name
+        self.written[name] = f.getvalue()
+
+
+class WriterPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="msg_mbox_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_submit_blocks_while_queue_is_full(self):
+        sink = GateSink()
+        pool = msg_mbox_core.WriterPool(sink, threads=1, max_bytes=10)
+        pool.submit("a", b"x" * 6)
+        submitter = threading.Thread(target=pool.submit, args=("b", b"y" * 6))
+        submitter.start()
+        submitter.join(0.2)
+        # 6 + 6 байт больше лимита: второе письмо ждёт, пока запишется первое
+        self.assertTrue(submitter.is_alive())
+        sink.gate.set()
+        submitter.join(5)
+        self.assertFalse(submitter.is_alive())
+        results = pool.close()
+        self.assertEqual(sink.written, {"a": b"x" * 6, "b": b"y" * 6})
+        self.assertEqual([error for *_rest, error in results], [None, None])
+
+    def test_oversized_message_is_not_blocked(self):
+        sink = GateSink()
+        sink.gate.set()
+        pool = msg_mbox_core.WriterPool(sink, threads=1, max_bytes=10)
+        pool.submit("big", b"z" * 100)
+        pool.close()
+        self.assertEqual(sink.written, {"big": b"z" * 100})
+
+    def test_write_errors_are_returned_to_caller(self):
+        sink = GateSink(failing={"b"})
+        sink.gate.set()
+        done = []
+        pool = msg_mbox_core.WriterPool(sink, threads=2)
+        for name in ("a", "b", "c"):
+            pool.submit(name, name.encode(), done.append)
+        results = {location: (on_done, error) for on_done, location, _size, _seconds, error in pool.close()}
+        self.assertEqual(sorted(sink.written), ["a", "c"])
+        self.assertIsInstance(results["b"][1], OSError)
+        self.assertIsNone(results["a"][1])
+        # on_done вызывает только collect() в потоке конвертера
+        self.assertEqual(done, [])
+
+    def test_failed_write_is_reported_without_partial_file(self):
+        mbox_path = os.path.join(self.workdir, "mail.mbox")
+        with open(mbox_path, "wb") as f:
+            f.write(b"".join(mbox_message(i, f"Letter {i}") for i in range(1, 6)))
+        output_dir = os.path.join(self.workdir, "out")
+        original = msg_mbox_core.DirectorySink.open
+
+        @contextlib.contextmanager
+        def half_written(sink, name):
+            with original(sink, name) as (f, location):
+                if name.startswith("3_"):
+                    f.write(b"From: half")
+                    raise OSError("диск заполнен")
+                yield f, location
+
+        converter = MessageConverter(output_dir)
+        with mock.patch.object(msg_mbox_core.DirectorySink, "open", half_written):
+            converted = converter.convert_mbox_to_eml(mbox_path)
+        converter.close()
+        self.assertEqual(len(converted), 4)
+        self.assertEqual(converter.stats["write_errors"], 1)
+        [error] = converter.stats.take_errors()
+        self.assertIn("диск заполнен", error["error"])
+        self.assertEqual(sink_subjects(output_dir, "directory"), [f"Letter {i}" for i in (1, 2, 4, 5)])
+
+
+class CancellationTest(unittest.TestCase):
+    """Отмена останавливает конвертацию на границе письма, без недописанных результатов"""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="msg_mbox_test_")
+        self.messages = {}
+        self.files = []
+        for name, prefix, count in (("first.mbox", "First", 30), ("second.mbox", "Second", 10)):
+            messages = [mbox_message(i, f"{prefix} {i}") for i in range(1, count + 1)]
+            self.messages.update((f"{prefix} {i}", message) for i, message in enumerate(messages, start=1))
+            self.files.append(os.path.join(self.workdir, name))
+            with open(self.files[-1], "wb") as f:
+                f.write(b"".join(messages))
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def convert(self, output_dir, sink, cancel_after=None):
+        def cancel(snapshot):
+            if cancel_after is not None and snapshot["messages"] >= cancel_after:
+                progress.cancel()
+
+        progress = msg_mbox_core.ConversionProgress(callback=cancel, interval=0)
+        converter = MessageConverter(output_dir, resume=True, sink=sink)
+        results = list(iter_conversion_results(self.files, converter, 1, progress))
+        return results, progress
+
+    def check_sink(self, sink):
+        output_dir = os.path.join(self.workdir, sink)
+        results, progress = self.convert(output_dir, sink, cancel_after=20)
+        self.assertTrue(progress.cancelled)
+        # второй ящик после отмены не начинается
+        self.assertEqual([(path, len(result), error) for path, result, error in results],
+                         [(self.files[0], 20, None)])
+        subjects = sink_subjects(output_dir, sink)
+        self.assertEqual(subjects, sorted(f"First {i}" for i in range(1, 21)))
+        if sink == "directory":
+            for path in results[0][1]:
+                with open(path, "rb") as f:
+                    data = f.read()
+                subject = BytesHeaderParser().parsebytes(data)["Subject"]
+                self.assertEqual(data, msg_mbox_core.mbox_entry_bytes(self.messages[subject]))
+
+        # повторный запуск с журналом доделывает оставшееся без повторов
+        results, _progress = self.convert(output_dir, sink)
+        self.assertEqual([len(result) for _path, result, _error in results], [30, 10])
+        self.assertEqual(sink_subjects(output_dir, sink), sorted(self.messages))
+
+    def test_directory(self):
+        self.check_sink("directory")
+
+    def test_zip(self):
+        self.check_sink("zip")
+
+    def test_mbox(self):
+        self.check_sink("mbox")
+
+
+class JournalResumeTest(unittest.TestCase):
+    """Повторный запуск с журналом пропускает записанное и доделывает остальное"""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="msg_mbox_test_")
+        self.output_dir = os.path.join(self.workdir, "out")
+        self.mbox_path = os.path.join(self.workdir, "mail.mbox")
+        with open(self.mbox_path, "wb") as f:
+            f.write(b"".join(mbox_message(i, f"Letter {i}") for i in range(1, 11)))
+        self.msg_path = os.path.join(self.workdir, "letter.msg")
+        build_msg_file(message_spec(attachment_size=1024), self.msg_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def convert(self, files):
+        converter = MessageConverter(self.output_dir, resume=True)
+        try:
+            results = {path: result for path, result, _error in iter_conversion_results(files, converter, 1)}
+        finally:
+            converter.close()
+        return results, converter.stats
+
+    def outputs(self):
+        return sorted(name for name in os.listdir(self.output_dir) if name.endswith(".eml"))
+
+    def test_second_run_skips_everything(self):
+        first, stats = self.convert([self.mbox_path, self.msg_path])
+        self.assertEqual(stats["written"], 11)
+        outputs = self.outputs()
+        second, stats = self.convert([self.mbox_path, self.msg_path])
+        self.assertEqual(stats["written"], 0)
+        self.assertEqual(second, first)
+        self.assertEqual(self.outputs(), outputs)
+
+    def test_failed_message_is_retried(self):
+        original = msg_mbox_core.sanitize_filename
+
+        def failing(name):
+            if name.startswith("5_"):
+                raise ValueError("сбой письма")
+            return original(name)
+
+        with mock.patch.object(msg_mbox_core, "sanitize_filename", failing):
+            first, stats = self.convert([self.mbox_path])
+        self.assertEqual(len(first[self.mbox_path]), 9)
+        self.assertEqual(stats["message_errors"], 1)
+
+        second, stats = self.convert([self.mbox_path])
+        self.assertEqual(stats["written"], 1)
+        self.assertEqual(len(second[self.mbox_path]), 10)
+        self.assertEqual(sink_subjects(self.output_dir, "directory"), sorted(f"Letter {i}" for i in range(1, 11)))
+
+    def test_changed_source_is_converted_again(self):
+        self.convert([self.mbox_path])
+        with open(self.mbox_path, "ab") as f:
+            f.write(mbox_message(11, "Letter 11"))
+        _results, stats = self.convert([self.mbox_path])
+        # изменённый ящик — новый источник: его письма пишутся рядом, без перезаписи
+        self.assertEqual(stats["written"], 11)
+        self.assertEqual(len(self.outputs()), 21)
+
+
+class UniqueNamesTest(unittest.TestCase):
+    """Одноимённые источники не перезаписывают результаты друг друга"""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="msg_mbox_test_")
+        self.files = []
+        for n, subject in enumerate(("first", "second")):
+            folder = os.path.join(self.workdir, f"in{n}")
+            os.makedirs(folder)
+            spec = message_spec(attachment_size=1024)
+            spec["subject"] = subject
+            spec["message_id"] = f"<{subject}@test>"
+            self.files.append(os.path.join(folder, "letter.msg"))
+            build_msg_file(spec, self.files[-1])
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def convert(self, sink, workers=1, files=None):
+        output_dir = os.path.join(self.workdir, f"out-{sink}-{workers}")
+        converter = MessageConverter(output_dir, workers=workers, sink=sink)
+        results = list(iter_conversion_results(files or self.files, converter, workers))
+        self.assertEqual([error for _path, _result, error in results], [None] * len(results))
+        return output_dir
+
+    def test_directory(self):
+        output_dir = self.convert("directory")
+        self.assertEqual(sorted(n for n in os.listdir(output_dir) if n.endswith(".eml")),
+                         ["letter.eml", "letter_1.eml"])
+        self.assertEqual(sink_subjects(output_dir, "directory"), ["first", "second"])
+
+    def test_directory_pool(self):
+        output_dir = self.convert("directory", workers=2)
+        self.assertEqual(sink_subjects(output_dir, "directory"), ["first", "second"])
+
+    def test_zip(self):
+        output_dir = self.convert("zip")
+        with zipfile.ZipFile(os.path.join(output_dir, "messages.zip")) as archive:
+            self.assertEqual(sorted(archive.namelist()), ["letter.eml", "letter_1.eml"])
+        self.assertEqual(sink_subjects(output_dir, "zip"), ["first", "second"])
+
+    def test_mbox_sources_with_same_subjects(self):
+        files = []
+        for name in ("a.mbox", "b.mbox"):
+            files.append(os.path.join(self.workdir, name))
+            with open(files[-1], "wb") as f:
+                f.write(mbox_message(1, "Same"))
+        output_dir = self.convert("directory", files=files)
+        self.assertEqual(sorted(n for n in os.listdir(output_dir) if n.endswith(".eml")),
+                         ["1_Same.eml", "1_Same_1.eml"])
+
+
+class ProfileDumpTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="msg_mbox_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_profile_written_once_on_close(self):
+        import cProfile
+        mbox_path = os.path.join(self.workdir, "mail.mbox")
+        with open(mbox_path, "wb") as f:
+            f.write(b"".join(mbox_message(i, f"Письмо {i}") for i in range(1, 6)))
+        converter = MessageConverter(os.path.join(self.workdir, "out"), profile_sample=1.0)
+        with mock.patch.object(cProfile.Profile, "dump_stats", autospec=True,
+                               side_effect=cProfile.Profile.dump_stats) as dump:
+            self.assertEqual(len(converter.convert_mbox_to_eml(mbox_path)), 5)
+            self.assertEqual(dump.call_count, 0)
+            converter.close()
+            self.assertEqual(dump.call_count, 1)
+        self.assertEqual(converter.stats["profiled"], 5)
+        report_dir = os.path.join(self.workdir, "out", msg_mbox_core.REPORT_DIR)
+        self.assertEqual(os.listdir(report_dir), [f"profile-{os.getpid()}.prof"])
+
+
+class SearchReindexTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="msg_mbox_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def write_mbox(self, path, subjects):
+        with open(path, "wb") as f:
+            f.write(b"".join(mbox_message(i, subject) for i, subject in enumerate(subjects, start=1)))
+
+    def test_reindex_removes_old_words(self):
+        mbox_path = os.path.join(self.workdir, "mail.mbox")
+        self.write_mbox(mbox_path, ["Отчёт апрель", "Счёт апрель", "Встреча"])
+        index = msg_mbox_core.SearchIndex(os.path.join(self.workdir, "search.sqlite"))
+        try:
+            self.assertEqual(index.index_file(mbox_path), 3)
+            self.assertEqual(len(index.search("апрель")), 2)
+
+            # переписанный ящик: хвост не совпадает, источник индексируется заново
+            self.write_mbox(mbox_path, ["Отчёт май", "Встреча"])
+            os.utime(mbox_path, (1, 1))
+            self.assertEqual(index.index_file(mbox_path), 2)
+            self.assertEqual(index.search("апрель"), [])
+            self.assertEqual([row[4] for row in index.search("май")], ["Отчёт май"])
+            self.assertEqual([row[1] for row in index.search("встреча")], [2])
+            # в FTS не осталось слов удалённых писем
+            index.db.execute("INSERT INTO message_text (message_text, rank) VALUES ('integrity-check', 1)")
+            index.db.execute("CREATE VIRTUAL TABLE temp.terms USING fts5vocab(main, message_text, row)")
+            terms = {row[0] for row in index.db.execute("SELECT term FROM temp.terms")}
+            self.assertNotIn("апрель", terms)
+            self.assertIn("май", terms)
+        finally:
+            index.close()
+
+
+class DedupReportTest(unittest.TestCase):
+    def test_seconds_saved_counts_whole_conversion(self):
+        stats = msg_mbox_core.ConversionStats(duplicates=2, written=2, write_seconds=0.01)
+        stats.record_message("a.msg", 2.0)
+        stats.record_message("b.msg", 4.0)
+        stats.record_message("a_copy.msg", 0.25, duplicate=True)
+        stats.record_message("b_copy.msg", 0.25, duplicate=True)
+        # письма из процессов пула суммируются без повторного учёта
+        total = msg_mbox_core.ConversionStats()
+        total.merge(stats)
+        for report in (msg_mbox_core.dedup_report(stats), msg_mbox_core.dedup_report(total)):
+            self.assertEqual(report["duplicates"], 2)
+            self.assertEqual(report["seconds_saved"], 5.5)
+
+
+class DedupContentKeyTest(unittest.TestCase):
+    """Письма без Message-ID совпадают по содержимому между MSG и MBOX, с LF и CRLF"""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="msg_mbox_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def write_mbox(self, name, message, newline):
+        path = os.path.join(self.workdir, name)
+        data = message.as_bytes().replace(b"\r\n", b"\n")
+        with open(path, "wb") as f:
+            f.write((b"From sender@example.ru Mon Jan  4 10:00:00 2021\n" + data + b"\n").replace(b"\n", newline))
+        return path
+
+    def test_same_message_in_msg_and_mbox(self):
+        spec = message_spec()
+        spec["message_id"] = ""
+        msg_path = os.path.join(self.workdir, "letter.msg")
+        build_msg_file(spec, msg_path)
+
+        message = EmailMessage()
+        message["Subject"] = spec["subject"]
+        message.set_content(spec["body"])
+        message.add_alternative(spec["html"], subtype="html")
+        for name, data, mime_type in spec["attachments"]:
+            maintype, subtype = mime_type.split("/")
+            message.add_attachment(data, maintype=maintype, subtype=subtype, filename=name)
+        for name, data, cid in spec["inline"]:
+            message.add_attachment(data, maintype="image", subtype="png", filename=name, cid=f"<{cid}>")
+        lf_path = self.write_mbox("lf.mbox", message, b"\n")
+        crlf_path = self.write_mbox("crlf.mbox", message, b"\r\n")
+        message.get_payload()[-1].set_content(b"other", maintype="image", subtype="png", filename="image0.png")
+        other_path = self.write_mbox("other.mbox", message, b"\n")
+
+        converter = MessageConverter(os.path.join(self.workdir, "out"), dedup=True)
+        try:
+            self.assertIsNotNone(converter.convert_msg_to_eml(msg_path))
+            self.assertEqual(converter.convert_mbox_to_eml(lf_path), [])
+            self.assertEqual(converter.convert_mbox_to_eml(crlf_path), [])
+            self.assertEqual(len(converter.convert_mbox_to_eml(other_path)), 1)
+        finally:
+            converter.close()
+        self.assertEqual(converter.stats["duplicates"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()